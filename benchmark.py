@@ -0,0 +1,291 @@
+'''
+Offline benchmarks for kerchunk store conversion and loading.
+
+Generates synthetic kerchunk json (see synthetic.py) for each requested
+case, then times and memory-profiles each stage in a fresh process:
+ - process   : Converter.process into a .kst store
+ - load      : Converter.load back to a full refs dict
+ - lazy      : unpack.get_mapper open plus random single key lookups
+ - generator : kpg_convert.install_generators from the same json
+ - gen_unpack: kpg_convert.GeneratorIndex full unpack
+ - parquet   : parquet.to_parquet of the store into kerchunk's Parquet refs
+ - parquet_lazy: LazyReferenceMapper open, random lookups and full scan,
+   against the same keys as lazy
+ - from_parquet: parquet.from_parquet back into a .kst store
+
+Results, including store and parquet sizes against the original json, are
+written as json so runs on different versions can be compared. The parquet
+stages need pandas with pyarrow or fastparquet.
+
+Example:
+    python benchmark.py --chunks 10000 1000000 --variables 1 4 -o bench.json
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import time
+
+from datetime import datetime
+
+from synthetic import write_kerchunk
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+def _run(queue, func, args):
+    # Child side of measure, reports wall/cpu time and peak memory of one stage
+    from convert import peak_rss
+    import convert
+    convert.VERBOSE = False
+    base = peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        result = func(*args)
+        error = None
+    except Exception as err:
+        result, error = None, f'{type(err).__name__}: {err}'
+    queue.put({
+        'wall_s': round(time.perf_counter() - wall, 4),
+        'cpu_s': round(time.process_time() - cpu, 4),
+        'base_rss_mb': round(base, 1),
+        'peak_rss_mb': round(peak_rss(), 1),
+        'result': result,
+        'error': error,
+    })
+
+def measure(func, *args):
+    # Run a stage in a freshly spawned interpreter so peak RSS is its own
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(queue, func, args))
+    proc.start()
+    out = queue.get()
+    proc.join()
+    return out
+
+## Stages ##
+
+def stage_process(kfile, outdir, fmt, stream, workers):
+    from convert import Converter
+    conv = Converter(kfile, outdir)
+    conv.process(stream=stream, fmt=fmt, workers=workers)
+    return {'store': conv.store, 'gfactor': conv.gfactors}
+
+def stage_load(kfile, outdir, workers):
+    from convert import Converter
+    refs = Converter(kfile, outdir).load(workers=workers)
+    return {'refs': len(refs['refs'])}
+
+def random_keys(grids, nkeys, seed):
+    # The same random chunk keys for any format, from {variable: chunk grid}
+    rng = random.Random(seed)
+    keys = []
+    for name in sorted(grids):
+        for i in range(nkeys // len(grids) or 1):
+            keys.append(f'{name}/' + '.'.join(str(rng.randrange(g)) for g in grids[name]))
+    return keys
+
+def time_lookups(refs, keys):
+    t0 = time.perf_counter()
+    refs[keys[0]]
+    first = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for key in keys:
+        refs[key]
+    lookups = time.perf_counter() - t0
+    return {
+        'first_lookup_s': round(first, 6),
+        'lookups': len(keys),
+        'lookup_us': round(lookups / len(keys) * 1e6, 2),
+    }
+
+def stage_lazy(store, nkeys, seed):
+    from unpack import get_mapper
+    t0 = time.perf_counter()
+    refs = get_mapper('reference://', fo=store).fs.references
+    opened = time.perf_counter() - t0
+
+    grids = {}
+    for var in refs.vars.values():
+        var.load()
+        grids[var.var] = var.grid
+    result = {'open_s': round(opened, 6), **time_lookups(refs, random_keys(grids, nkeys, seed))}
+
+    # Every chunk ref, pack by pack
+    t0 = time.perf_counter()
+    count = 0
+    for var in refs.vars.values():
+        for part in var.parts():
+            count += len(part.unpack_gen())
+    result.update(scan_s=round(time.perf_counter() - t0, 4), scan_refs=count)
+    return result
+
+def stage_parquet(store, pqdir):
+    from parquet import to_parquet
+    return {'chunks': to_parquet(store, pqdir)}
+
+def stage_parquet_lazy(pqdir, variables, nkeys, seed):
+    from fsspec.implementations.reference import LazyReferenceMapper
+    from parquet import chunk_grid, iter_parquet, parquet_engine
+    t0 = time.perf_counter()
+    refs = LazyReferenceMapper(pqdir, engine=parquet_engine())
+    refs.zmetadata
+    opened = time.perf_counter() - t0
+
+    # The variables packed in the store, so both formats look up the same keys
+    grids = {name: chunk_grid(refs.zmetadata[f'{name}/.zarray']) for name in variables}
+    result = {'open_s': round(opened, 6), **time_lookups(refs, random_keys(grids, nkeys, seed))}
+
+    t0 = time.perf_counter()
+    count = sum(1 for key, ref in iter_parquet(refs) if isinstance(ref, list))
+    result.update(scan_s=round(time.perf_counter() - t0, 4), scan_refs=count)
+    return result
+
+def stage_from_parquet(pqdir, outdir, fmt, workers):
+    from parquet import from_parquet
+    conv = from_parquet(pqdir, outdir, fmt=fmt, workers=workers)
+    return {'store': conv.store}
+
+def stage_generator(kfile):
+    import kpg_convert
+    f = open(kfile, 'r')
+    out = json.load(f)
+    f.close()
+    t0 = time.perf_counter()
+    variables, dims = kpg_convert.access_kerchunk(out)
+    out = kpg_convert.install_generators(out, variables, dims)
+    return {
+        'install_s': round(time.perf_counter() - t0, 4),
+        'gfactor': out['gen']['gfactor'],
+        'gen_bytes': len(json.dumps(out['gen'])),
+    }
+
+def stage_gen_unpack(kfile):
+    import kpg_convert
+    f = open(kfile, 'r')
+    out = json.load(f)
+    f.close()
+    out = kpg_convert.install_generators(out, *kpg_convert.access_kerchunk(out))
+    t0 = time.perf_counter()
+    index = kpg_convert.GeneratorIndex(out['gen'])
+    built = time.perf_counter() - t0
+    refs = index.unpack()
+    return {
+        'index_s': round(built, 4),
+        'unpack_s': round(time.perf_counter() - t0, 4),
+        'refs': len(refs),
+    }
+
+STAGES = ['process', 'load', 'lazy', 'generator', 'gen_unpack', 'parquet', 'parquet_lazy', 'from_parquet']
+
+def run_case(case, args):
+    workdir = os.path.join(args.workdir, f"c{case['chunks']}_v{case['variables']}")
+    os.makedirs(workdir, exist_ok=True)
+    kfile = os.path.join(workdir, 'synthetic.json')
+    outdir = os.path.join(workdir, 'kstore')
+
+    print(f"[INFO] Case {case}")
+    t0 = time.perf_counter()
+    layout = write_kerchunk(
+        kfile, nchunks=case['chunks'], nvars=case['variables'], nfiles=args.files,
+        irregular=args.irregular, gaps=args.gaps, inline=not args.no_inline, seed=args.seed)
+    result = {
+        'params': case,
+        'layout': layout,
+        'generate_s': round(time.perf_counter() - t0, 4),
+        'kfile_bytes': os.path.getsize(kfile),
+        'stages': {},
+    }
+
+    stages = result['stages']
+    if 'process' in args.stages:
+        stages['process'] = measure(stage_process, kfile, outdir, args.fmt, args.stream, args.workers)
+        store = (stages['process']['result'] or {}).get('store')
+        if store:
+            result['store_bytes'] = dir_size(store)
+            result['ratio'] = round(result['kfile_bytes'] / max(result['store_bytes'], 1), 2)
+    if 'load' in args.stages:
+        stages['load'] = measure(stage_load, kfile, outdir, args.workers)
+    if 'lazy' in args.stages and result.get('store_bytes'):
+        stages['lazy'] = measure(stage_lazy, stages['process']['result']['store'], args.lookups, args.seed)
+    if 'generator' in args.stages:
+        stages['generator'] = measure(stage_generator, kfile)
+    if 'gen_unpack' in args.stages:
+        stages['gen_unpack'] = measure(stage_gen_unpack, kfile)
+    if 'parquet' in args.stages and result.get('store_bytes'):
+        pqdir = os.path.join(workdir, 'synthetic.parq')
+        stages['parquet'] = measure(stage_parquet, stages['process']['result']['store'], pqdir)
+        if not stages['parquet']['error']:
+            result['parquet_bytes'] = dir_size(pqdir)
+            result['parquet_ratio'] = round(result['kfile_bytes'] / max(result['parquet_bytes'], 1), 2)
+    if 'parquet_lazy' in args.stages and result.get('parquet_bytes'):
+        stages['parquet_lazy'] = measure(stage_parquet_lazy, pqdir, list(stages['parquet']['result']['chunks']),
+                                         args.lookups, args.seed)
+    if 'from_parquet' in args.stages and result.get('parquet_bytes'):
+        stages['from_parquet'] = measure(stage_from_parquet, pqdir, os.path.join(workdir, 'from_parquet'),
+                                         args.fmt, args.workers)
+
+    for name, stage in stages.items():
+        status = stage['error'] or f"{stage['wall_s']}s, peak {stage['peak_rss_mb']} MB"
+        print(f'[INFO]   {name}: {status}')
+
+    if not args.keep:
+        shutil.rmtree(workdir)
+    return result
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic convert/load benchmarks')
+    parser.add_argument('--chunks', type=float, nargs='+', default=[1e4, 1e5])
+    parser.add_argument('--variables', type=int, nargs='+', default=[1])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--irregular', type=float, default=0.05, help='fraction of odd sized chunks')
+    parser.add_argument('--gaps', type=float, default=0.01, help='fraction of chunks after a gap')
+    parser.add_argument('--no-inline', action='store_true', help='reference coordinates instead of inlining them')
+    parser.add_argument('--fmt', default='kpk', choices=['json', 'kpk', 'nc'])
+    parser.add_argument('--stream', action='store_true', help='use streaming ingest for process')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default='kbench')
+    parser.add_argument('--keep', action='store_true', help='keep generated files')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('chunks', 'variables', 'output')},
+        'cases': [],
+    }
+    for chunks in args.chunks:
+        for nvars in args.variables:
+            case = {'chunks': int(chunks), 'variables': nvars}
+            report['cases'].append(run_case(case, args))
+
+    f = open(args.output, 'w')
+    f.write(json.dumps(report, indent=2))
+    f.close()
+    print(f'[INFO] Written {args.output}')
+
+if __name__ == '__main__':
+    main()
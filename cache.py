@@ -0,0 +1,292 @@
+# Cache.py
+
+# Caches of unpacked per-variable reference tables and chunk bytes
+#  - TableCache holds (keys, table) pairs in an in-process LRU
+#  - An optional directory of .npz files backs it across processes
+#  - Entries are keyed by store, pack (variable or shard) and the pack mtime/size
+#    (or content hash), so rewritten packs are never served stale
+#  - ChunkCache holds chunk bytes keyed by their (file, offset, size) ref,
+#    in memory and optionally on disk, so repeated reads stay local
+#  - Both share TieredCache's memory LRU, atomic disk writes and eviction
+
+import hashlib
+import os
+import time
+import threading
+import uuid
+
+import numpy as np
+
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class TieredCache:
+    """
+    In-process LRU with an optional on-disk tier shared between processes.
+
+    maxbytes caps the memory held, directory/disk_maxbytes enable and cap
+    the on-disk tier. Disk entries are written atomically and evicted
+    oldest-used first under a lock, use is recorded in the file mtime as
+    atime is often not kept. A partial or vanished entry is a miss.
+    Subclasses give the entry path, size and file format of a payload.
+    """
+    # Extension of entry files, and the share of disk_maxbytes written between scans
+    ext = '.bin'
+    evict_slice = 0
+
+    def __init__(self, maxbytes, directory=None, disk_maxbytes=2**33):
+        self.maxbytes = maxbytes
+        self.directory = directory
+        self.disk_maxbytes = disk_maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def sizeof(self, payload):
+        raise NotImplementedError
+
+    def path(self, key):
+        raise NotImplementedError
+
+    def dump(self, f, payload):
+        raise NotImplementedError
+
+    def load(self, f, key):
+        raise NotImplementedError
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        payload = self.read_disk(key)
+        with self.lock:
+            if payload is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.hold(key, payload)
+        return payload
+
+    def store(self, key, payload):
+        self.hold(key, payload)
+        self.write_disk(key, payload)
+
+    def hold(self, key, payload):
+        size = self.sizeof(payload)
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = payload
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= self.sizeof(old)
+
+    def read_disk(self, key):
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+            payload = self.load(f, key)
+            f.close()
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return payload
+
+    def write_disk(self, key, payload):
+        size = self.sizeof(payload)
+        if not self.directory or size > self.disk_maxbytes:
+            return
+        path = self.path(key)
+        if os.path.isfile(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a unique name then moved so readers never see a partial file
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        f = open(tmp, 'wb')
+        self.dump(f, payload)
+        f.close()
+        os.replace(tmp, path)
+
+        # The directory is only scanned once a slice of the budget has been written
+        with self.lock:
+            self.written += size
+            due = self.written > self.disk_maxbytes * self.evict_slice
+            if due:
+                self.written = 0
+        if due:
+            self.evict_disk()
+
+    def disk_files(self):
+        # (mtime, size, path) of every entry file, clearing temporary files
+        # left by a writer that died
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp') and stat.st_mtime < time.time() - 3600:
+                    os.remove(path)
+                elif name.endswith(self.ext):
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict_disk(self):
+        # One process at a time, others skip rather than wait
+        lock = open(os.path.join(self.directory, '.lock'), 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return
+            files = self.disk_files()
+            total = sum(f[1] for f in files)
+            for mtime, size, path in sorted(files):
+                if total <= self.disk_maxbytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            lock.close()
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+        if disk and self.directory:
+            for mtime, size, path in self.disk_files():
+                os.remove(path)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+        }
+
+class TableCache(TieredCache):
+    """
+    LRU cache of Variable.unpack_arrays results.
+
+    Entries are keyed by pack and its version, the disk tier holds them as
+    .npz files and is scanned after every write as tables are few and large.
+    """
+    ext = '.npz'
+
+    def __init__(self, maxbytes=2**30, directory=None, disk_maxbytes=2**33, hashing=False):
+        super().__init__(maxbytes, directory=directory, disk_maxbytes=disk_maxbytes)
+        self.hashing = hashing
+
+    def key(self, var):
+        pack = f'{var.store}/{var.pack}.{var.fmt}'
+        if self.hashing:
+            digest = hashlib.sha1()
+            f = open(pack, 'rb')
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+            f.close()
+            version = digest.hexdigest()
+        else:
+            stat = os.stat(pack)
+            version = f'{stat.st_mtime_ns}-{stat.st_size}'
+        return (os.path.abspath(var.store), var.pack, version)
+
+    def sizeof(self, arrays):
+        return sum(a.nbytes for a in arrays)
+
+    def path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f'{name}.npz')
+
+    def dump(self, f, arrays):
+        np.savez(f, keys=arrays[0], table=arrays[1])
+
+    def load(self, f, key):
+        npz = np.load(f, allow_pickle=False)
+        arrays = (npz['keys'], npz['table'])
+        npz.close()
+        return arrays
+
+    def get(self, var):
+        return self.lookup(self.key(var))
+
+    def put(self, var, arrays):
+        for a in arrays:
+            a.setflags(write=False)
+        self.store(self.key(var), arrays)
+
+    def fetch(self, var, lead=None):
+        # Cached arrays for var, unpacking and storing them on a miss
+        arrays = self.get(var)
+        if arrays is None:
+            arrays = var.unpack_arrays()
+            self.put(var, arrays)
+        if lead is None:
+            return arrays
+        index, _ = var.select(*lead)
+        return arrays[0][index], arrays[1][index]
+
+# Shared by every Converter in the process, KSTORE_CACHE_DIR adds a disk tier
+TABLES = TableCache(directory=os.environ.get('KSTORE_CACHE_DIR'))
+
+class ChunkCache(TieredCache):
+    """
+    LRU cache of chunk bytes keyed by (file, offset, size).
+
+    Disk entries are spread over subdirectories, and the directory is only
+    scanned for eviction once a sixteenth of disk_maxbytes has been written.
+    """
+    evict_slice = 1 / 16
+
+    def __init__(self, maxbytes=2**28, directory=None, disk_maxbytes=2**34):
+        super().__init__(maxbytes, directory=directory, disk_maxbytes=disk_maxbytes)
+
+    def sizeof(self, data):
+        return len(data)
+
+    def path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, name[:2], f'{name}.bin')
+
+    def dump(self, f, data):
+        f.write(data)
+
+    def load(self, f, key):
+        data = f.read()
+        if len(data) != key[2]:
+            raise ValueError(f'Partial cache entry for {key}')
+        return data
+
+    def get(self, url, offset, size):
+        return self.lookup((url, int(offset), int(size)))
+
+    def put(self, url, offset, size, data):
+        self.store((url, int(offset), int(size)), bytes(data))
+
+# Chunk bytes shared by store mappers asked to cache, KSTORE_CHUNK_DIR adds a disk tier
+CHUNKS = ChunkCache(directory=os.environ.get('KSTORE_CHUNK_DIR'))
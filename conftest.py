@@ -0,0 +1,11 @@
+# Conftest.py
+
+# The older test_*.py files are scripts run against CEDA data and kerchunk
+# files on JASMIN, not pytest cases, so they are left out of collection
+collect_ignore = [
+    'test_convert.py',
+    'test_kerchunk_unpack.py',
+    'test_read.py',
+    'tests/test_dap_local.py',
+    'tests/test_kerchunks.py',
+]
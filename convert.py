@@ -7,14 +7,25 @@
 #  - meta.json with only the metadata
 #  - var.nc for each variable
 
+import base64
 import json
 import numpy as np
 import os
+import warnings
 
+from array import array
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from netCDF4 import Dataset
 from scipy import stats
 
-from json import JSONEncoder
+from cache import TableCache, TABLES
+from paths import compress_paths, expand_paths
+from tracing import peak_rss, traced
+
+from json import JSONEncoder, JSONDecodeError
+from json.decoder import WHITESPACE
 
 ERRORS = {
     "File": "[FileError]"
@@ -22,6 +33,9 @@ ERRORS = {
 
 VERBOSE=True
 
+# Unpacked reference columns, file is an index into the store file list
+REF_DTYPE = np.dtype([('file', np.int64), ('offset', np.int64), ('size', np.int64)])
+
 def vprint(msg, err=None):
     if VERBOSE:
         status = '[INFO]'
@@ -29,6 +43,353 @@ def vprint(msg, err=None):
             status = ERRORS[err]
         print(f'{status}: {msg}')
 
+def pack_counts(ext):
+    # Span counts for a Variable method writing its pack file
+    def counts(args, kwargs, result):
+        var = args[0]
+        return {'chunks': var.chunks, 'bytes': os.path.getsize(f'{var.store}/{var.pack}.{ext}')}
+    return counts
+
+def iter_kfile(kfile, blocksize=2**22):
+    """
+    Incrementally parse a kerchunk json file.
+
+    Yields (key, value) for top level entries and ('refs', key, value) for
+    each reference, holding at most one block of the file in memory.
+    """
+    decoder = json.JSONDecoder()
+    f = open(kfile,'r')
+    buf, pos, eof = '', 0, False
+
+    def fill(buf, pos):
+        block = f.read(blocksize)
+        return buf[pos:] + block, 0, not block
+
+    def skip(buf, pos, eof, chars):
+        # Move past whitespace and any of chars, reading more as needed
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] in chars:
+                pos += 1
+                continue
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    def decode(buf, pos, eof):
+        # Decode one complete json value, extending the buffer if truncated
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    return value, buf, end, eof
+            except JSONDecodeError:
+                if eof:
+                    raise
+            buf, pos, eof = fill(buf, pos)
+
+    def entries(buf, pos, eof, nested):
+        # Walk the members of an object, returning at its closing brace
+        while True:
+            buf, pos, eof = skip(buf, pos, eof, ',')
+            if pos >= len(buf):
+                raise ValueError(f'Unexpected end of {kfile}')
+            if buf[pos] == '}':
+                return buf, pos+1, eof
+            key, buf, pos, eof = decode(buf, pos, eof)
+            buf, pos, eof = skip(buf, pos, eof, ':')
+            if key == 'refs' and not nested:
+                buf, pos, eof = skip(buf, pos, eof, '{')
+                buf, pos, eof = yield from entries(buf, pos, eof, True)
+                continue
+            value, buf, pos, eof = decode(buf, pos, eof)
+            if nested:
+                yield ('refs', key, value)
+            else:
+                yield (key, value)
+
+    buf, pos, eof = skip(buf, pos, eof, '{')
+    yield from entries(buf, pos, eof, False)
+    f.close()
+
+# Binary pack layout
+#  - magic, little-endian uint32 header length, json header
+#  - header lists each column as [dtype, count, byte offset]
+#  - columns are fixed width and 8-byte aligned so they can be memory mapped
+PACK_MAGIC = b'KPK1'
+PACK_ALIGN = 8
+
+def write_pack(path, columns):
+    header, offset = {}, 0
+    columns = {name: np.ascontiguousarray(col) for name, col in columns.items()}
+    for name, col in columns.items():
+        header[name] = [col.dtype.str, len(col), offset]
+        offset += -(-col.nbytes // PACK_ALIGN) * PACK_ALIGN
+
+    hbytes = json.dumps(header).encode()
+    start = len(PACK_MAGIC) + 4 + len(hbytes)
+    start = -(-start // PACK_ALIGN) * PACK_ALIGN
+
+    f = open(path,'wb')
+    f.write(PACK_MAGIC)
+    f.write(np.uint32(len(hbytes)).tobytes())
+    f.write(hbytes)
+    for name, col in columns.items():
+        f.seek(start + header[name][2])
+        f.write(col.tobytes())
+    # Pad the final column so every view lies within the file
+    f.truncate(start + offset)
+    f.close()
+
+# Dimension of each packed array in netCDF packs, columns indexed alike share one
+NC_DIMS = {
+    'unique_ids': 'unique_dim', 'unique_lengths': 'unique_dim',
+    'gap_ids': 'gaps_dim', 'gap_lengths': 'gaps_dim',
+    'grid': 'grid_dim',
+    'key_ids': 'keys_dim', 'key_starts': 'keys_dim',
+    'fileids': 'files_dim', 'filerefs': 'files_dim',
+}
+
+def read_nc(path):
+    # Packed arrays from a netCDF pack, read into memory with their stored dtypes
+    ncf = Dataset(path, 'r')
+    ncf.set_auto_mask(False)
+    columns = {name: ncf.variables[name][:] for name in NC_DIMS}
+    ncf.close()
+    return columns
+
+def read_pack(path):
+    # Columns are read-only views onto a shared memory map, nothing is parsed
+    mm = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(mm[:len(PACK_MAGIC)]) != PACK_MAGIC:
+        raise ValueError(f'{path} is not a packed variable file')
+    hlen = int(np.frombuffer(mm, dtype='<u4', count=1, offset=len(PACK_MAGIC))[0])
+    hstart = len(PACK_MAGIC) + 4
+    header = json.loads(bytes(mm[hstart:hstart+hlen]))
+    start = -(-(hstart + hlen) // PACK_ALIGN) * PACK_ALIGN
+
+    columns = {}
+    for name, (dtype, count, offset) in header.items():
+        columns[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=start+offset)
+    return columns
+
+def key_coords(key):
+    # Grid coordinates of a single chunk key such as '3.0.1', ValueError for anything else
+    coords = [int(c) for c in key.split('.')]
+    if min(coords) < 0:
+        raise ValueError(f'Negative chunk index in {key}')
+    return coords
+
+def split_keys(keys, ndim, skip=0):
+    """
+    Coordinates of the chunk keys among keys, read from position skip.
+
+    Keys are parsed in one pass unless some are not ndim-part chunk keys
+    as key_coords reads them. Returns the (n, ndim) coordinates of the
+    valid keys and a boolean mask of which keys those are.
+    """
+    labels = [key[skip:] for key in keys] if skip else list(keys)
+    valid = np.ones(len(labels), dtype=bool)
+    ndots = np.fromiter(map(str.count, labels, repeat('.')), dtype=np.int64, count=len(labels))
+    coords = join_keys(labels)
+    if np.any(ndots != ndim - 1) or len(coords) != len(labels) * ndim or np.any(coords < 0):
+        valid = np.fromiter(map(is_key, labels, repeat(ndim)), dtype=bool, count=len(labels))
+        coords = join_keys([l for l, v in zip(labels, valid) if v])
+    return coords.reshape(int(valid.sum()), ndim), valid
+
+def join_keys(labels):
+    # Flat int coordinates of chunk keys, short if any key is malformed
+    if not labels:
+        return np.zeros(0, dtype=np.int64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return np.fromstring('.'.join(labels), dtype=np.int64, sep='.')
+
+def is_key(label, ndim):
+    # Chunk key add_ref would accept for a variable of ndim dimensions
+    try:
+        return len(key_coords(label)) == ndim
+    except ValueError:
+        return False
+
+def parse_keys(keys, ndim=None):
+    # Chunk key strings to an (n, ndim) coordinate array, ValueError if any is malformed
+    keys = np.asarray(keys, dtype=str).tolist()
+    if not keys:
+        return np.zeros((0, ndim or 1), dtype=np.int64)
+    coords, valid = split_keys(keys, ndim or keys[0].count('.') + 1)
+    if not valid.all():
+        raise ValueError(f'Malformed chunk key {keys[int(np.argmin(valid))]}')
+    return coords
+
+def format_keys(gidx, grid, prefix=''):
+    # Chunk key strings for C-order grid indices, the inverse of parse_keys
+    # Each dimension's labels are formatted once and gathered by index
+    coords = np.unravel_index(gidx, grid)
+    labels = [np.array([str(i) for i in range(g)]) for g in grid]
+    keys = np.char.add(prefix, labels[0])[coords[0]]
+    for label, dim in zip(labels[1:], coords[1:]):
+        keys = np.char.add(np.char.add(keys, '.'), label[dim])
+    return keys
+
+def zarray_grid(zarray):
+    # Number of chunks along each dimension of a .zarray, None without a shape
+    if isinstance(zarray, str):
+        zarray = json.loads(zarray)
+    if not isinstance(zarray, dict) or not zarray.get('shape'):
+        return None
+    return [-(-s // c) for s, c in zip(zarray['shape'], zarray['chunks'])]
+
+# Refs under these names are always kept as metadata
+KEYWORDS = ['time','lat','lon','.zarray','zgroup','.zattrs']
+
+def chunk_ref(key, ref):
+    # [variable, chunk key] for refs packed into a variable, None for metadata refs
+    parts = key.split('/')
+    if len(parts) != 2 or parts[0] in KEYWORDS or parts[1][0] == '.':
+        return None
+    if not isinstance(ref, list) or len(ref) != 3:
+        # Inline data and whole file refs
+        return None
+    return parts
+
+def encode_offsets(offsets, sizes, starts):
+    # Residual of each offset against the end of the previous chunk
+    # The first chunk of each file run (at starts) keeps its absolute offset
+    residuals = offsets.copy()
+    residuals[1:] -= offsets[:-1] + sizes[:-1]
+    residuals[starts] = offsets[starts]
+    return residuals
+
+def decode_offsets(residuals, sizes, ends):
+    """
+    Rebuild offsets from contiguous-layout residuals.
+
+    Within a file run offset[i] = offset[i-1] + size[i-1] + residual[i],
+    the first chunk of each run holds its absolute offset.
+    """
+    starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+    inc = residuals.copy()
+    inc[1:] += sizes[:-1]
+    inc[starts] = residuals[starts]
+    total = np.cumsum(inc)
+    base = total[starts] - residuals[starts]
+    return total - np.repeat(base, np.diff(ends, prepend=0))
+
+def key_runs(gidx):
+    # Runs of consecutive grid indices as (position, grid index) of each run start
+    breaks = np.flatnonzero(np.diff(gidx) != 1) + 1
+    keyids = np.concatenate(([0], breaks)).astype(np.int64)
+    return keyids, gidx[keyids]
+
+def inline_bytes(ref):
+    # Raw bytes of an inline reference
+    if ref.startswith('base64:'):
+        return base64.b64decode(ref[7:])
+    return ref.encode()
+
+# Inline data refs at least this long are kept in the sidecar, not meta.json
+INLINE_MIN = 128
+INLINE_FILE = 'inline.bin'
+
+def encode_inline(data, encoding):
+    # Inline ref string as it appeared in the kerchunk refs
+    if encoding == 'base64':
+        return 'base64:' + base64.b64encode(data).decode()
+    return data.decode()
+
+def split_inline(refs):
+    """
+    Separate inline data refs worth moving to the sidecar.
+
+    Returns the refs left for meta.json and {key: (bytes, encoding)}.
+    Only refs whose string can be rebuilt exactly from the bytes are moved,
+    .zarray/.zattrs style metadata always stays.
+    """
+    kept, payloads = {}, {}
+    for key, ref in refs.items():
+        if isinstance(ref, str) and len(ref) >= INLINE_MIN and not key.split('/')[-1].startswith('.'):
+            encoding = 'base64' if ref.startswith('base64:') else 'text'
+            data = inline_bytes(ref)
+            if encode_inline(data, encoding) == ref:
+                payloads[key] = (data, encoding)
+                continue
+        kept[key] = ref
+    return kept, payloads
+
+def write_inline(store, payloads):
+    # Payloads back to back in the sidecar, returns {key: [offset, size, encoding]}
+    path = os.path.join(store, INLINE_FILE)
+    if not payloads:
+        if os.path.isfile(path):
+            os.remove(path)
+        return {}
+    index, offset = {}, 0
+    f = open(f'{path}.tmp', 'wb')
+    for key, (data, encoding) in payloads.items():
+        f.write(data)
+        index[key] = [offset, len(data), encoding]
+        offset += len(data)
+    f.close()
+    os.replace(f'{path}.tmp', path)
+    return index
+
+class InlineRefs(Mapping):
+    """
+    Inline refs held in a store's inline.bin sidecar, read when asked for.
+
+    Items are the original ref strings, data gives the raw bytes.
+    """
+    def __init__(self, store, index=None):
+        self.path = os.path.join(store, INLINE_FILE)
+        self.index = dict(index or {})
+
+    def data(self, key):
+        offset, size, _ = self.index[key]
+        f = open(self.path, 'rb')
+        f.seek(offset)
+        data = f.read(size)
+        f.close()
+        return data
+
+    def __getitem__(self, key):
+        return encode_inline(self.data(key), self.index[key][2])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def refs(self):
+        # Every ref string, reading the sidecar once
+        if not self.index:
+            return {}
+        f = open(self.path, 'rb')
+        data = f.read()
+        f.close()
+        return {
+            key: encode_inline(data[offset:offset+size], encoding)
+            for key, (offset, size, encoding) in self.index.items()
+        }
+
+def load_attrs(ref):
+    # .zarray/.zattrs refs may be held as json strings or dicts
+    if isinstance(ref, str):
+        return json.loads(ref)
+    return ref
+
+def index_dtype(n):
+    # Narrowest signed int able to index n items
+    return np.int32 if n < 2**31 else np.int64
+
+def stored_ints(values):
+    # Int column as read from a pack, kpk columns keep their on-disk dtype
+    # so they stay mapped rather than copied, json lists become int64
+    if isinstance(values, np.ndarray):
+        return values
+    return np.asarray(values, dtype=np.int64)
+
 class NumpyArrayEncoder(JSONEncoder):
     def default(self,obj):
         if isinstance(obj,np.ndarray):
@@ -36,30 +397,50 @@ class NumpyArrayEncoder(JSONEncoder):
         return JSONEncoder.default(self,obj)
 
 class Variable:
-    def __init__(self, var, store):
+    def __init__(self, var, store, fmt='json'):
         self.var = var
         self.store = store
+        # File name of the pack, the variable name unless sharded
+        self.pack = var
+        self.fmt = fmt
         self.files = []
-        self.sizes = []
-        self.offsets = []
-        self.keys = []
+        self.sizes = array('q')
+        self.offsets = array('q')
+        self.coords = array('q')
+        self.ndim = None
         self.fileids = []
+        self.filerefs = []
         self.fcounter = 0
         self.latestfile = None
+        self.loaded = False
 
-    def configure(self, chunks, msize, moffset, fileset):
+    def configure(self, chunks, msize, moffset, fileset, fmt='json', encoding='mode'):
         self.chunks = chunks
         self.msize = msize
         self.moffset = moffset
         self.fileset = fileset
+        self.fmt = fmt
+        self.encoding = encoding
+
+    def parse_key(self, key):
+        # Grid coordinates of a chunk key, ValueError unless it fits this variable
+        coords = key_coords(key)
+        if self.ndim is not None and len(coords) != self.ndim:
+            raise ValueError(f'Inconsistent chunk key {self.var}/{key}')
+        return coords
+
+    def update(self, coords, segments, fileref=None):
+        # Chunk keys are kept as grid coordinates, not strings, see parse_key
+        if self.ndim is None:
+            self.ndim = len(coords)
 
-    def update(self, key, segments):
         # Update arrays with new attributes
         if segments[0] != self.latestfile:
             self.fileids.append(self.fcounter)
+            self.filerefs.append(fileref)
             self.latestfile = segments[0]
         self.fcounter += 1
-        self.keys.append(key)
+        self.coords.extend(coords)
         self.offsets.append(segments[1])
         self.sizes.append(segments[2])
 
@@ -67,131 +448,661 @@ class Variable:
         return [self.chunks, self.msize, self.moffset]
 
     def read_entry(self):
-        jsfile = f'{self.store}/{self.var}.json'
+        if self.fmt == 'kpk':
+            return read_pack(f'{self.store}/{self.pack}.kpk')
+        if self.fmt == 'nc':
+            return read_nc(f'{self.store}/{self.pack}.nc')
+        jsfile = f'{self.store}/{self.pack}.json'
         f = open(jsfile,'r')
         refs = json.load(f)
         f.close()
         return refs
 
-    def unpack_gen(self):
+    def get_filerefs(self, refs):
+        # Index into the store file list for each file run
+        # Older stores assume runs follow the file list in order
+        if 'filerefs' in refs:
+            return stored_ints(refs['filerefs'])
+        return np.arange(len(refs['fileids']), dtype=np.int64)
 
+    def load(self):
+        # Read packed arrays once for on-demand lookups, no refs expanded
+        if self.loaded:
+            return
         refs = self.read_entry()
-        uniqueids     = np.array(refs['unique_ids'], dtype=int)
-        uniquelengths = np.array(refs['unique_lengths'], dtype=int)
+        self.uniqueids     = stored_ints(refs['unique_ids'])
+        self.uniquelengths = stored_ints(refs['unique_lengths'])
+        self.gapids        = stored_ints(refs['gap_ids'])
+        self.gaplengths    = stored_ints(refs['gap_lengths'])
+        self.fileids       = stored_ints(refs['fileids'])
+        self.filerefs      = self.get_filerefs(refs)
 
-        gapids        = np.array(refs['gap_ids'],dtype=int)
-        gaplengths    = np.array(refs['gap_lengths'],dtype=int)
+        if 'grid' in refs:
+            self.grid      = tuple(int(g) for g in refs['grid'])
+            self.keyids    = stored_ints(refs['key_ids'])
+            self.keystarts = stored_ints(refs['key_starts'])
+        else:
+            # Older stores hold every key string, rebuild the runs from them
+            coords = parse_keys(refs['keys'])
+            self.set_keys(coords, coords.max(axis=0) + 1)
+        self.inverse = None
+        self.sums    = None
+        self.loaded  = True
 
-        keys = refs['keys']
-        fileids = refs['fileids']
+    def set_keys(self, coords, grid):
+        # Store keys as runs of consecutive C-order grid indices
+        self.grid = tuple(int(g) for g in grid)
+        gidx = np.ravel_multi_index(tuple(coords.T), self.grid)
+        self.keyids, self.keystarts = key_runs(gidx)
 
-        # Assume we've already collected the json/netcdf contents
-        # Also assume we have the file arrays and everything
-        sizes   = np.zeros(self.chunks, dtype=int) + self.msize
-        files   = []
-        offsets = np.zeros(self.chunks, dtype=int) + self.moffset
+    def key_index(self):
+        # Grid index of every chunk in pack order
+        self.load()
+        runs = np.diff(self.keyids, append=self.chunks)
+        return np.repeat(self.keystarts - self.keyids, runs) + np.arange(self.chunks, dtype=np.int64)
 
-        # Extract file list
-        init = 0
-        for x, f in enumerate(self.fileset):
-            for y in range(init, fileids[x]):
-                files.append(f)
-            init = fileids[x]
+    def key_index_at(self, pos):
+        # Grid index of the chunks at pack positions pos, without key_index
+        self.load()
+        run = np.searchsorted(self.keyids, pos, side='right') - 1
+        return self.keystarts[run] + pos - self.keyids[run]
 
-        # Get sizes
-        sizes[uniqueids] = uniquelengths
-        offsets[gapids] = gaplengths
+    def chunk_keys(self, prefix='', gidx=None):
+        # Rebuild the chunk key strings from the grid, for every chunk or gidx
+        if gidx is None:
+            gidx = self.key_index()
+        return format_keys(gidx, self.grid, prefix)
 
-        # Offsets currently reversed
+    def find(self, key):
+        # Position of a chunk key within the packed arrays, or None
+        self.load()
+        try:
+            coords = tuple(int(c) for c in key.split('.'))
+        except ValueError:
+            return None
+        if len(coords) != len(self.grid) or any(c < 0 or c >= g for c, g in zip(coords, self.grid)):
+            return None
+        gidx = int(np.ravel_multi_index(coords, self.grid))
+        pos = int(self.positions(np.array([gidx]))[0])
+        return pos if pos >= 0 else None
 
-        chunk_array = np.reshape(np.transpose([files, np.array(offsets,dtype=int), np.array(sizes, dtype=int)]), (self.chunks, 3))
-        unpacked_refs = {}
-        for c in range(self.chunks):
-            unpacked_refs[f'{self.var}/{keys[c]}'] = list(chunk_array[c])
+    def positions(self, gidx):
+        # Pack positions of an array of grid indices, -1 where not stored
+        if self.inverse is None:
+            lengths = np.diff(self.keyids, append=self.chunks)
+            ends = self.keystarts + lengths
+            if np.all(self.keystarts[1:] >= ends[:-1]):
+                # Runs ascend through the grid, binary search the run starts
+                self.inverse = False
+            else:
+                # Keys out of order, map grid index to position directly
+                self.inverse = np.full(int(np.prod(self.grid)), -1, dtype=index_dtype(self.chunks))
+                self.inverse[self.key_index()] = np.arange(self.chunks)
 
-        return unpacked_refs
-        
-    def pack_gen(self):
+        if self.inverse is False:
+            run = np.searchsorted(self.keystarts, gidx, side='right') - 1
+            valid = run >= 0
+            run = np.maximum(run, 0)
+            pos = self.keyids[run] + gidx - self.keystarts[run]
+            nxt = np.minimum(run + 1, len(self.keyids) - 1)
+            ends = np.where(run + 1 < len(self.keyids), self.keyids[nxt], self.chunks)
+            return np.where(valid & (pos < ends), pos, -1)
+
+        return self.inverse[gidx].astype(np.int64)
+
+    def find_many(self, keys):
+        # Pack positions of many chunk keys, -1 for keys not in the pack
+        self.load()
+        coords, valid = split_keys(keys, len(self.grid))
+        inside = np.all(coords < np.array(self.grid), axis=1)
+        pos = np.full(len(keys), -1, dtype=np.int64)
+        pos[np.flatnonzero(valid)[inside]] = self.positions(np.ravel_multi_index(tuple(coords[inside].T), self.grid))
+        return pos
+
+    def lookup_many(self, keys):
+        # {key: [file, offset, size]} for the chunk keys found in the pack
+        pos = self.find_many(keys)
+        found = np.flatnonzero(pos >= 0)
+        rows = self.refs_at(pos[found])
+        names = {f: self.fileset[f] for f in np.unique(rows['file']).tolist()}
+        return {
+            keys[i]: [names[f], o, s]
+            for i, f, o, s in zip(found.tolist(), rows['file'].tolist(), rows['offset'].tolist(), rows['size'].tolist())
+        }
+
+    def lookup(self, key):
+        # Work out [file, offset, size] for a single chunk key
+        index = self.find(key)
+        if index is None:
+            raise KeyError(f'{self.var}/{key}')
+
+        size = self.msize
+        u = int(np.searchsorted(self.uniqueids, index))
+        if u < len(self.uniqueids) and self.uniqueids[u] == index:
+            size = int(self.uniquelengths[u])
+
+        run = int(np.searchsorted(self.fileids, index, side='right'))
+        if self.encoding == 'contiguous':
+            offset = int(self.run_offsets(index, run, u))
+        else:
+            offset = self.moffset
+            g = np.searchsorted(self.gapids, index)
+            if g < len(self.gapids) and self.gapids[g] == index:
+                offset = int(self.gaplengths[g])
+        return [self.fileset[self.filerefs[run]], offset, size]
+
+    def exception_sums(self):
+        # Prefix sums of the size and offset exceptions against msize and moffset
+        if self.sums is None:
+            self.sums = (
+                np.concatenate(([0], np.cumsum(self.uniquelengths - self.msize))),
+                np.concatenate(([0], np.cumsum(self.gaplengths - self.moffset))),
+            )
+        return self.sums
+
+    def run_offsets(self, pos, run, u):
+        """
+        Contiguous offsets at pack positions pos, without a full decode.
+
+        run is the file run of each position and u its searchsorted place
+        in uniqueids. Each run starts with a gap entry holding its absolute
+        offset, later chunks add the usual size and spacing for every chunk
+        since, corrected by prefix sums over the exceptions in between.
+        """
+        usum, gsum = self.exception_sums()
+        start = np.where(run > 0, self.fileids[np.maximum(run - 1, 0)], 0).astype(np.int64)
+        gs = np.searchsorted(self.gapids, start)
+        ge = np.searchsorted(self.gapids, pos, side='right')
+        us = np.searchsorted(self.uniqueids, start)
+        return (self.gaplengths[gs] + (pos - start) * (self.msize + self.moffset)
+                + usum[u] - usum[us] + gsum[ge] - gsum[gs + 1])
+
+    def refs_at(self, pos):
+        # Reference rows for an array of pack positions, as ref_table()[pos]
+        self.load()
+        rows = np.empty(len(pos), dtype=REF_DTYPE)
+        run = np.searchsorted(self.fileids, pos, side='right')
+        rows['file'] = self.filerefs[run]
+
+        rows['size'] = self.msize
+        u = np.searchsorted(self.uniqueids, pos)
+        hit = np.flatnonzero(u < len(self.uniqueids))
+        hit = hit[self.uniqueids[u[hit]] == pos[hit]]
+        rows['size'][hit] = self.uniquelengths[u[hit]]
+
+        if self.encoding == 'contiguous':
+            rows['offset'] = self.run_offsets(pos, run, u)
+            return rows
+        rows['offset'] = self.moffset
+        g = np.searchsorted(self.gapids, pos)
+        hit = np.flatnonzero(g < len(self.gapids))
+        hit = hit[self.gapids[g[hit]] == pos[hit]]
+        rows['offset'][hit] = self.gaplengths[g[hit]]
+        return rows
+
+    def ref_table(self):
+        # Expand the packed arrays into int64 reference columns
+        # file column holds indices into self.fileset
+        self.load()
+        table = np.empty(self.chunks, dtype=REF_DTYPE)
+        table['size']   = self.msize
+        table['offset'] = self.moffset
+
+        # File runs end at each fileid
+        runs = np.diff(self.fileids, prepend=0)
+        table['file'] = np.repeat(self.filerefs, runs)
+
+        table['size'][self.uniqueids] = self.uniquelengths
+        table['offset'][self.gapids]  = self.gaplengths
+
+        if self.encoding == 'contiguous':
+            table['offset'] = decode_offsets(table['offset'], table['size'], self.fileids)
+        return table
+
+    def select(self, start, stop):
+        # Pack positions and grid indices of chunks with leading index in [start, stop)
+        gidx = self.key_index()
+        lead = gidx // int(np.prod(self.grid[1:]))
+        index = np.flatnonzero((lead >= start) & (lead < stop))
+        return index, gidx[index]
+
+    def unpack_arrays(self, lead=None):
+        # lead limits the chunks to a (start, stop) range of leading chunk indices
+        if lead is None:
+            return self.chunk_keys(prefix=f'{self.var}/'), self.ref_table()
+        index, gidx = self.select(*lead)
+        return self.chunk_keys(prefix=f'{self.var}/', gidx=gidx), self.ref_table()[index]
+
+    @traced('unpack_gen', lambda a, k, r: {'chunks': len(r)})
+    def unpack_gen(self, lead=None):
+        return self.refs_from_arrays(*self.unpack_arrays(lead=lead))
+
+    def refs_from_arrays(self, keys, table):
+        # Shared string objects per file rather than one per chunk
+        # Only the paths of files this variable uses are built
+        used = np.unique(table['file'])
+        names = np.empty(len(self.fileset), dtype=object)
+        names[used] = [self.fileset[i] for i in used.tolist()]
+        files = names[table['file']]
+
+        return dict(zip(
+            keys.tolist(),
+            map(list, zip(files.tolist(), table['offset'].tolist(), table['size'].tolist()))
+        ))
+
+    @traced('pack_gen', lambda a, k, r: {'chunks': a[0].chunks})
+    def pack_gen(self, grid=None):
         vprint(f'Packing {self.var}')
         self.chunks = len(self.sizes)
-        sizes = np.array(self.sizes,dtype=int)
-        offsets = np.array(self.offsets,dtype=int)
+
+        coords = np.frombuffer(self.coords, dtype=np.int64).reshape(self.chunks, self.ndim)
+        self.set_keys(coords, self.fit_grid(grid))
+        del coords
+        del self.coords
+
+        sizes = np.frombuffer(self.sizes, dtype=np.int64)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
         
         self.msize = int(stats.mode(sizes).mode)
-        self.moffset = int(stats.mode(offsets).mode)
-
         self.uniquelengths = sizes[sizes != self.msize]
         self.uniqueids = np.arange(0,len(sizes))[sizes != self.msize]
 
-        self.gaplengths = offsets[offsets != self.moffset]
-        self.gapids = np.arange(0,len(offsets))[offsets != self.moffset]
+        # Predict each offset from the end of the previous chunk in the same file
+        # Only residuals that differ from the usual spacing are stored
+        starts = np.array(self.fileids, dtype=np.int64)
+        residuals = encode_offsets(offsets, sizes, starts)
+
+        inner = np.ones(self.chunks, dtype=bool)
+        inner[starts] = False
+        self.moffset = int(stats.mode(residuals[inner]).mode) if inner.any() else 0
+
+        gaps = residuals != self.moffset
+        gaps[starts] = True
+        self.gaplengths = residuals[gaps]
+        self.gapids = np.arange(0,len(offsets))[gaps]
+        self.encoding = 'contiguous'
 
         del sizes
         del offsets
+        del residuals
         del self.sizes
         del self.offsets
 
+        vprint(f'{self.var}: {self.chunks} chunks, gfactor {self.gfactor():.3f}')
 
-        # Get uniqueids, uniquelengths
-        # Get gapids, gaplengths
+    def fit_grid(self, grid):
+        # Chunk grid from the .zarray, widened to cover every ingested key
+        extent = np.frombuffer(self.coords, dtype=np.int64).reshape(-1, self.ndim).max(axis=0) + 1
+        if grid is None or len(grid) != self.ndim or np.any(extent > grid):
+            vprint(f'Chunk grid for {self.var} taken from its keys')
+            grid = extent if grid is None or len(grid) != self.ndim else np.maximum(grid, extent)
+        return grid
 
-    def write_nc(self):
-        ncfile = f'{self.store}/{self.var}.nc'
-        ncf_new = Dataset(ncfile, 'w', format='NETCDF4')
+    def append_gen(self, new, nlead=None, filemap=None):
+        """
+        Extend the packed arrays with the chunks ingested by another Variable.
 
-        unique_dim = ncf_new.createDimension('unique_dim',len(self.uniqueids))
-        keys_dim = ncf_new.createDimension('keys_dim',len(self.keys))
-        gaps_dim = ncf_new.createDimension('gaps_dim',len(self.gapids))
+        New chunks follow on along the leading dimension, nlead chunks beyond
+        the current grid. Exceptions are taken against the existing msize and
+        moffset so nothing already packed is rewritten. filemap gives the
+        index in the combined store file list of each new file ref.
+        """
+        self.load()
+        if self.encoding != 'contiguous':
+            raise ValueError(f'{self.var} uses the older offset encoding, reprocess the store before appending')
+        nnew = len(new.sizes)
+        if new.ndim != len(self.grid):
+            raise ValueError(f'New chunks for {self.var} have {new.ndim} dimensions, store has {len(self.grid)}')
 
-        unique_ids = ncf_new.createVariable('unique_ids', np.int32, ('unique_dim',))
-        unique_ids[:] = self.uniqueids
-        unique_lens = ncf_new.createVariable('unique_lengths', np.int32, ('unique_dim',))
-        unique_lens[:] = self.uniquelengths
+        coords = np.frombuffer(new.coords, dtype=np.int64).reshape(nnew, new.ndim).copy()
+        extent = coords.max(axis=0) + 1
+        if nlead is None:
+            nlead = int(extent[0])
+        if extent[0] > nlead or np.any(extent[1:] > self.grid[1:]):
+            raise ValueError(f'New chunks for {self.var} do not fit the chunk grid {self.grid}')
 
-        gap_ids = ncf_new.createVariable('gap_ids', np.int32, ('gaps_dim',))
-        gap_ids[:] = self.gapids
-        gap_lens = ncf_new.createVariable('gap_lengths', np.int32, ('gaps_dim',))
-        gap_lens[:] = self.gaplengths
+        # Growing the leading dimension leaves existing C-order indices unchanged
+        grid = (self.grid[0] + nlead,) + self.grid[1:]
+        coords[:, 0] += self.grid[0]
+        keyids, keystarts = key_runs(np.ravel_multi_index(tuple(coords.T), grid))
+        keyids += self.chunks
+        if keystarts[0] == self.keystarts[-1] + self.chunks - self.keyids[-1]:
+            # First new chunk continues the last run
+            keyids, keystarts = keyids[1:], keystarts[1:]
 
-        keys = ncf_new.createVariable('keys', np.str_, ('keys_dim',))
-        keys[:] = np.array(self.keys)
+        sizes = np.frombuffer(new.sizes, dtype=np.int64)
+        starts = np.array(new.fileids, dtype=np.int64)
+        residuals = encode_offsets(np.frombuffer(new.offsets, dtype=np.int64), sizes, starts)
+        unique = sizes != self.msize
+        gaps = residuals != self.moffset
+        gaps[starts] = True
 
-    def write_json(self):
-        jsfile = f'{self.store}/{self.var}.json'
-        self.fileids.append(self.fcounter)
-        refs = {
+        base = self.chunks
+        ends = np.concatenate((self.fileids, np.append(starts[1:], nnew) + base))
+        self.uniqueids     = np.concatenate((self.uniqueids, np.flatnonzero(unique) + base))
+        self.uniquelengths = np.concatenate((self.uniquelengths, sizes[unique]))
+        self.gapids        = np.concatenate((self.gapids, np.flatnonzero(gaps) + base))
+        self.gaplengths    = np.concatenate((self.gaplengths, residuals[gaps]))
+        self.keyids        = np.concatenate((self.keyids, keyids))
+        self.keystarts     = np.concatenate((self.keystarts, keystarts))
+        self.grid          = grid
+        self.chunks       += nnew
+
+        # Back to the ingest form of file runs expected by get_pack
+        self.fileids  = np.concatenate(([0], ends[:-1])).tolist()
+        if filemap is None:
+            filemap = range(max(new.filerefs) + 1)
+        self.filerefs = self.filerefs.tolist() + [filemap[f] for f in new.filerefs]
+        self.fcounter = self.chunks
+        self.loaded   = False
+
+    def subset(self, index, shift=0, filemap=None):
+        """
+        New ingest Variable holding the chunks at index, in the same order.
+
+        shift moves them along the leading dimension, filemap renumbers
+        their file refs.
+        """
+        coords = np.frombuffer(self.coords, dtype=np.int64).reshape(-1, self.ndim)[index]
+        coords[:, 0] += shift
+        runs = np.diff(np.append(self.fileids, self.fcounter))
+        refs = np.repeat(np.asarray(self.filerefs, dtype=np.int64), runs)[index]
+        if filemap is not None:
+            refs = np.asarray(filemap, dtype=np.int64)[refs]
+        starts = np.flatnonzero(np.diff(refs, prepend=-1))
+
+        part = Variable(self.var, self.store, fmt=self.fmt)
+        part.ndim = self.ndim
+        part.coords.frombytes(coords.tobytes())
+        part.offsets.frombytes(np.frombuffer(self.offsets, dtype=np.int64)[index].tobytes())
+        part.sizes.frombytes(np.frombuffer(self.sizes, dtype=np.int64)[index].tobytes())
+        part.fileids = starts.tolist()
+        part.filerefs = refs[starts].tolist()
+        part.fcounter = len(index)
+        return part
+
+    def split(self, size, nlead, start=0, shift=0, filemap=None):
+        # (lo, hi, ingest Variable) for each run of size leading chunk indices from start up to nlead
+        # shift and filemap are passed on to subset
+        leads = np.frombuffer(self.coords, dtype=np.int64)[::self.ndim]
+        shards = []
+        for lo in range(start, nlead, size):
+            hi = min(lo + size, nlead)
+            index = np.flatnonzero((leads >= lo) & (leads < hi))
+            if len(index):
+                shards.append((lo, hi, self.subset(index, shift=shift, filemap=filemap)))
+        return shards
+
+    def parts(self, lead=None):
+        # Packs to read for a range of leading chunk indices
+        return [self]
+
+    def write(self):
+        if self.fmt == 'kpk':
+            self.write_bin()
+        elif self.fmt == 'nc':
+            self.write_nc()
+        else:
+            self.write_json()
+
+    def gfactor(self):
+        # Fraction of chunks described without an exception entry
+        exceptions = len(self.uniqueids) + len(self.gapids) + len(self.keyids)
+        return 1 - exceptions/self.chunks
+
+    def get_pack(self):
+        # Packed arrays as written to the store, fileids close at the final chunk
+        return {
             'unique_ids':self.uniqueids,
             'unique_lengths':self.uniquelengths,
             'gap_ids':self.gapids,
             'gap_lengths':self.gaplengths,
-            'keys':self.keys,
-            'fileids':self.fileids[1:],
+            'grid':list(self.grid),
+            'key_ids':self.keyids,
+            'key_starts':self.keystarts,
+            'fileids':self.fileids[1:] + [self.fcounter],
+            'filerefs':self.filerefs,
         }
+
+    @traced('write_json', pack_counts('json'))
+    def write_json(self):
+        jsfile = f'{self.store}/{self.pack}.json'
+        refs = self.get_pack()
         f = open(jsfile,'w')
         f.write(json.dumps(refs, cls=NumpyArrayEncoder))
         f.close()
         vprint(f'Written json {jsfile}')
 
+    def pack_columns(self):
+        # Packed arrays with the dtypes binary packs are written with
+        refs = self.get_pack()
+        idtype = index_dtype(self.chunks)
+        return {
+            'unique_ids':np.asarray(refs['unique_ids'], dtype=idtype),
+            'unique_lengths':np.asarray(refs['unique_lengths'], dtype=np.int64),
+            'gap_ids':np.asarray(refs['gap_ids'], dtype=idtype),
+            'gap_lengths':np.asarray(refs['gap_lengths'], dtype=np.int64),
+            'grid':np.asarray(refs['grid'], dtype=np.int64),
+            'key_ids':np.asarray(refs['key_ids'], dtype=idtype),
+            'key_starts':np.asarray(refs['key_starts'], dtype=np.int64),
+            'fileids':np.asarray(refs['fileids'], dtype=idtype),
+            'filerefs':np.asarray(refs['filerefs'], dtype=np.int32),
+        }
+
+    @traced('write_bin', pack_counts('kpk'))
+    def write_bin(self):
+        kpkfile = f'{self.store}/{self.pack}.kpk'
+        write_pack(kpkfile, self.pack_columns())
+        vprint(f'Written pack {kpkfile}')
+
+    @traced('write_nc', pack_counts('nc'))
+    def write_nc(self):
+        ncfile = f'{self.store}/{self.pack}.nc'
+        ncf_new = Dataset(ncfile, 'w', format='NETCDF4')
+        columns = self.pack_columns()
+        for name, column in columns.items():
+            if NC_DIMS[name] not in ncf_new.dimensions:
+                ncf_new.createDimension(NC_DIMS[name], len(column))
+        for name, column in columns.items():
+            ncvar = ncf_new.createVariable(name, column.dtype, (NC_DIMS[name],))
+            ncvar[:] = column
+        ncf_new.close()
+        vprint(f'Written nc {ncfile}')
+
+class ShardedVariable(Variable):
+    """
+    Variable packed as shards by ranges of its leading chunk index.
+
+    Each shard is a Variable of its own in <var>.<k>.json/kpk, with its own
+    msize and moffset, read only when a lookup or load needs it. index is
+    the variable's entry in the meta.json shard index.
+    """
+    def __init__(self, var, store, index, fmt='json'):
+        super().__init__(var, store, fmt=fmt)
+        self.size = index['size']
+        self.grid = tuple(index['grid'])
+        self.ranges = [tuple(r[:2]) for r in index['ranges']]
+        self.entries = [r[2:] for r in index['ranges']]
+        self.shards = []
+        self.dirty = set()
+
+    def configure(self, chunks, msize, moffset, fileset, fmt='json', encoding='mode'):
+        super().configure(chunks, msize, moffset, fileset, fmt=fmt, encoding=encoding)
+        self.shards = []
+        for k, entry in enumerate(self.entries):
+            shard = Variable(self.var, self.store, fmt=fmt)
+            shard.pack = f'{self.var}.{k}'
+            shard.configure(*entry[:3], fileset, fmt=fmt, encoding=encoding)
+            self.shards.append(shard)
+        self.offsets = np.cumsum([0] + [s.chunks for s in self.shards])
+
+    def get_index(self):
+        ranges = [[lo, hi, *entry] for (lo, hi), entry in zip(self.ranges, self.entries)]
+        return {'size': self.size, 'grid': list(self.grid), 'ranges': ranges}
+
+    def get_entry(self):
+        return [self.chunks, *self.entries[0][1:3]]
+
+    def gfactor(self):
+        return sum(e[0] * e[3] for e in self.entries) / self.chunks
+
+    def shard_of(self, key):
+        # Shard holding a chunk key by its leading index, or None
+        try:
+            lead = int(key.split('.')[0])
+        except ValueError:
+            return None
+        for k, (lo, hi) in enumerate(self.ranges):
+            if lo <= lead < hi:
+                return k
+        return None
+
+    def parts(self, lead=None):
+        if lead is None:
+            return list(self.shards)
+        return [s for s, (lo, hi) in zip(self.shards, self.ranges) if lo < lead[1] and hi > lead[0]]
+
+    def load(self):
+        for shard in self.shards:
+            shard.load()
+        self.loaded = True
+
+    def key_index(self):
+        return np.concatenate([s.key_index() for s in self.shards])
+
+    def ref_table(self):
+        return np.concatenate([s.ref_table() for s in self.shards])
+
+    def at_positions(self, pos, method):
+        # Results of a per-shard method for global pack positions, in order of pos
+        k = np.searchsorted(self.offsets, pos, side='right') - 1
+        out = None
+        for shard in np.unique(k).tolist():
+            where = np.flatnonzero(k == shard)
+            part = getattr(self.shards[shard], method)(pos[where] - self.offsets[shard])
+            if out is None:
+                out = np.empty(len(pos), dtype=part.dtype)
+            out[where] = part
+        return out if out is not None else np.empty(0, dtype=np.int64)
+
+    def key_index_at(self, pos):
+        return self.at_positions(pos, 'key_index_at')
+
+    def refs_at(self, pos):
+        return self.at_positions(pos, 'refs_at')
+
+    def find(self, key):
+        k = self.shard_of(key)
+        pos = None if k is None else self.shards[k].find(key)
+        return None if pos is None else int(self.offsets[k]) + pos
+
+    def lookup(self, key):
+        k = self.shard_of(key)
+        if k is None:
+            raise KeyError(f'{self.var}/{key}')
+        return self.shards[k].lookup(key)
+
+    def lookup_many(self, keys):
+        groups = {}
+        for key in keys:
+            k = self.shard_of(key)
+            if k is not None:
+                groups.setdefault(k, []).append(key)
+        refs = {}
+        for k, group in groups.items():
+            refs.update(self.shards[k].lookup_many(group))
+        return refs
 
+    def unpack_arrays(self, lead=None):
+        arrays = [s.unpack_arrays(lead=lead) for s in self.parts(lead)]
+        if not arrays:
+            return np.array([], dtype=str), np.empty(0, dtype=REF_DTYPE)
+        return np.concatenate([a[0] for a in arrays]), np.concatenate([a[1] for a in arrays])
+
+    def append_gen(self, new, nlead=None, filemap=None):
+        # New chunks fill the last shard up to size, the rest start new shards of size
+        coords = np.frombuffer(new.coords, dtype=np.int64).reshape(-1, new.ndim)
+        if nlead is None:
+            nlead = int(coords[:, 0].max()) + 1
+        grid = (self.grid[0] + nlead,) + self.grid[1:]
+        lo, hi = self.ranges[-1]
+        last = self.shards[-1]
+        take = 0
+        if hi == self.grid[0] and hi - lo < self.size:
+            # Only a shard ending at the current extent can grow in place
+            last.load()
+            if last.grid[0] == self.grid[0]:
+                take = min(self.size - (hi - lo), nlead)
+        if take:
+            index = np.flatnonzero(coords[:, 0] < take)
+            if len(index):
+                last.append_gen(new.subset(index), nlead=take, filemap=filemap)
+                self.dirty.add(len(self.shards) - 1)
+            self.ranges[-1] = (lo, hi + take)
+
+        for start, stop, shard in new.split(self.size, nlead, start=take, shift=self.grid[0], filemap=filemap):
+            shard.pack = f'{self.var}.{len(self.shards)}'
+            shard.fmt = self.fmt
+            shard.pack_gen(grid=grid)
+            shard.fileset = self.fileset
+            self.dirty.add(len(self.shards))
+            self.shards.append(shard)
+            self.ranges.append((self.grid[0] + start, self.grid[0] + stop))
+            self.entries.append(None)
+        self.grid = grid
+        self.chunks += len(new.sizes)
+
+    def write(self):
+        # Only the shards changed since the store was read
+        for k in sorted(self.dirty):
+            shard = self.shards[k]
+            shard.write()
+            self.entries[k] = [*shard.get_entry(), round(shard.gfactor(), 4)]
+        self.offsets = np.cumsum([0] + [s.chunks for s in self.shards])
+        self.dirty = set()
+
+def pack_variable(var, grid, fmt):
+    # Worker task, the Variable arrives with its buffers as array('q') bytes
+    var.pack_gen(grid=grid)
+    var.fmt = fmt
+    var.write()
+    return var.get_entry(), var.gfactor()
+
+def unpack_variable(var, lead=None):
+    # Worker task, only numpy columns are sent back
+    return var.unpack_arrays(lead=lead)
 
 class Converter:
-    def __init__(self,kfile, outpath):
+    def __init__(self,kfile, outpath, store=None):
         self.kfile = kfile
-        self.store = os.path.join(outpath, kfile.split('/')[-1].replace('.json','')) + '.kst'
+        if store:
+            self.store = store
+        else:
+            self.store = os.path.join(outpath, kfile.split('/')[-1].replace('.json','')) + '.kst'
         self.metadata = {}
         self.generator = {}
         self.vars = {}
+        self.files = []
+        self.fileindex = {}
+        self.latestfile = None
+        self.inline = InlineRefs(self.store)
+        self.gfactors = {}
+        self.fmt = 'json'
+        self.leads = {}
+        self.shard = None
+        self.shards = {}
 
+    @traced('get_kfile', lambda a, k, r: {'refs': len(r.get('refs', {}))})
     def get_kfile(self):
         f = open(self.kfile,'r')
         refs = json.load(f)
         f.close()
         return refs
 
+    @traced('deconstruct', lambda a, k, r: {'refs': len(a[1].get('refs', {})), 'variables': len(a[0].vars)})
     def deconstruct(self,refs):
 
         # Setup metadata dict
-        keywords = ['time','lat','lon','.zarray','zgroup','.zattrs']
         for key in refs.keys():
             if key == 'refs':
                 self.metadata[key] = {}
@@ -199,42 +1110,71 @@ class Converter:
                 self.metadata[key] = refs[key]
         
         # Setup vars dict
-        self.files = ['']
         for key in refs['refs'].keys():
-            try:
-                firstpart, secondpart = key.split('/')
-                if firstpart in keywords or secondpart[0] == '.' or len(refs['refs'][key]) > 3:
-                    self.metadata['refs'][key] = refs['refs'][key]
-                else:
-                    #print(firstpart, secondpart)
-                    #x=input()
-                    variable = firstpart
-                    if variable not in self.vars:
-                        self.vars[variable] = Variable(variable, self.store)
-                    self.vars[variable].update(secondpart, refs['refs'][key])
-                    if refs['refs'][key][0] != self.files[-1]:
-                        self.files.append(refs['refs'][key][0])
-
-            except ValueError:
-                self.metadata['refs'][key] = refs['refs'][key] 
+            self.add_ref(key, refs['refs'][key])
+
+    def add_ref(self, key, ref):
+        # Sort a single reference into metadata or a variable pack
+        parts = chunk_ref(key, ref)
+        if parts is None:
+            self.metadata['refs'][key] = ref
+            return
+        variable, secondpart = parts
+        # Keys are checked before the variable or file is registered
+        var = self.vars.get(variable) or Variable(variable, self.store)
+        try:
+            coords = var.parse_key(secondpart)
+        except ValueError:
+            self.metadata['refs'][key] = ref
+            return
+        self.vars[variable] = var
+        if ref[0] != self.latestfile:
+            # Each path is listed once, refs carry its index
+            if ref[0] not in self.fileindex:
+                self.fileindex[ref[0]] = len(self.files)
+                self.files.append(ref[0])
+            self.latestfile = ref[0]
+            self.latestref = self.fileindex[ref[0]]
+        var.update(coords, ref, self.latestref)
+
+    @traced('deconstruct_stream', lambda a, k, r: {'variables': len(a[0].vars)})
+    def deconstruct_stream(self, blocksize=2**22):
+        # Same as deconstruct, fed entry by entry from the kerchunk file
+        vprint('Streaming kerchunk file')
+        for item in iter_kfile(self.kfile, blocksize=blocksize):
+            if len(item) == 3:
+                self.metadata.setdefault('refs', {})
+                self.add_ref(item[1], item[2])
+            else:
+                self.metadata[item[0]] = item[1]
     
     def make_store(self):
         vprint('Ensuring store exists')
         if not os.path.isdir(self.store):
             os.makedirs(self.store)
 
+    @traced('write_meta', lambda a, k, r: {'refs': len(a[0].metadata['refs'])})
     def write_meta(self):
         vprint('Writing metadata')
         meta = os.path.join(self.store, 'meta.json' )
         self.metadata['vars'] = self.generator
-        self.metadata['files'] = self.files[1:]
+        self.metadata['files'] = compress_paths(self.files)
+        self.metadata['format'] = self.fmt
+        self.metadata['encoding'] = 'contiguous'
+        self.metadata['gfactor'] = self.gfactors
+        if self.shards:
+            self.metadata['shards'] = self.shards
+        # Large inline payloads go to the binary sidecar
+        refs, payloads = split_inline(self.metadata['refs'])
+        inline = write_inline(self.store, payloads)
         if not os.path.isfile(meta):
             os.system(f'touch {meta}')
         f = open(meta, 'w')
-        f.write(json.dumps(self.metadata))
+        f.write(json.dumps({**self.metadata, 'refs': refs, 'inline': inline}))
         f.close()
 
-    def read_meta(self):
+    @traced('read_meta', lambda a, k, r: {'refs': len(a[0].metadata['refs']), 'variables': len(a[0].vars)})
+    def read_meta(self, variables=None):
         meta = os.path.join(self.store, 'meta.json' )
         f = open(meta,'r')
         meta = json.load(f)
@@ -244,72 +1184,329 @@ class Converter:
             'version': meta['version'],
             'refs':meta['refs']
         }
+        self.inline = InlineRefs(self.store, meta.get('inline'))
 
+        # Stores written before binary packs have no format entry
+        self.fmt = meta.get('format', 'json')
+        encoding = meta.get('encoding', 'mode')
+        files = expand_paths(meta['files'])
+        if variables is not None:
+            missing = sorted(set(variables) - set(meta['vars']))
+            if missing:
+                raise ValueError(f'Variables {missing} are not in store {self.store}')
+            # Other packed variables are left out of the refs entirely
+            for var in set(meta['vars']) - set(variables):
+                for key in [k for k in self.metadata['refs'] if k.split('/')[0] == var]:
+                    del self.metadata['refs'][key]
+                for key in [k for k in self.inline.index if k.split('/')[0] == var]:
+                    del self.inline.index[key]
+        self.shards = meta.get('shards', {})
         for var in meta['vars'].keys():
-            self.vars[var] = Variable(var, self.store)
-            self.vars[var].configure(*meta['vars'][var], meta['files'])
+            if variables is not None and var not in variables:
+                continue
+            if var in self.shards:
+                self.vars[var] = ShardedVariable(var, self.store, self.shards[var])
+            else:
+                self.vars[var] = Variable(var, self.store)
+            self.vars[var].configure(*meta['vars'][var], files, fmt=self.fmt, encoding=encoding)
 
-    def write_vars(self):
+    def write_vars(self, workers=None):
         vprint('Writing variables')
+        # Each task packs a whole variable, or one shard of it
+        tasks, owners = [], []
         for var in self.vars.values():
-            var.pack_gen()
-            var.write_json()
-            entry = var.get_entry()
-            self.generator[var.var] = entry
+            grid = self.get_grid(var.var)
+            if not self.shard:
+                tasks.append((var, grid, self.fmt))
+                owners.append((var.var, None))
+                continue
+            grid = [int(g) for g in var.fit_grid(grid)]
+            self.shards[var.var] = {'size': self.shard, 'grid': grid, 'ranges': []}
+            for k, (lo, hi, part) in enumerate(var.split(self.shard, grid[0])):
+                part.pack = f'{var.var}.{k}'
+                tasks.append((part, grid, self.fmt))
+                owners.append((var.var, [lo, hi]))
+            var.coords, var.offsets, var.sizes = array('q'), array('q'), array('q')
+
+        if workers and workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+                results = list(pool.map(pack_variable, *zip(*tasks)))
+        else:
+            results = [pack_variable(*task) for task in tasks]
+
+        for (name, lead), (entry, gfactor) in zip(owners, results):
+            if lead is None:
+                self.generator[name] = entry
+                self.gfactors[name] = round(gfactor, 4)
+            else:
+                self.shards[name]['ranges'].append([*lead, *entry, round(gfactor, 4)])
+        for name, index in self.shards.items():
+            ranges = index['ranges']
+            chunks = sum(r[2] for r in ranges)
+            self.generator[name] = [chunks, *ranges[0][3:5]]
+            self.gfactors[name] = round(sum(r[2] * r[5] for r in ranges) / chunks, 4)
+
+    def get_grid(self, var):
+        # Number of chunks along each dimension from the variable's .zarray
+        return zarray_grid(self.metadata['refs'].get(f'{var}/.zarray'))
 
-    def read_vars(self):
+    def read_vars(self, workers=None, processes=False, cache=None):
         vprint('Reading variables')
-        refs = {}
+        # One task per pack file, shards outside the selected leads are not read
+        packs, leads = [], []
         for var in self.vars.values():
-            refs = {**refs, **var.unpack_gen()}
+            lead = self.leads.get(var.var)
+            for part in var.parts(lead):
+                packs.append(part)
+                leads.append(lead)
+        if cache is not None:
+            # Unpacked once per pack file, then served from the cache
+            refs = {}
+            for pack, lead in zip(packs, leads):
+                refs.update(pack.refs_from_arrays(*cache.fetch(pack, lead)))
+            return refs
+
+        if workers and workers > 1 and len(packs) > 1:
+            Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            with Executor(max_workers=min(workers, len(packs))) as pool:
+                arrays = pool.map(unpack_variable, packs, leads)
+                # Build each pack's refs as its arrays arrive
+                refs = {}
+                for pack, (keys, table) in zip(packs, arrays):
+                    refs.update(pack.refs_from_arrays(keys, table))
+            return refs
+
+        refs = {}
+        for pack, lead in zip(packs, leads):
+            refs.update(pack.unpack_gen(lead=lead))
         return refs
 
-    def construct(self):
+    @traced('construct', lambda a, k, r: {'refs': len(a[0].metadata['refs'])})
+    def construct(self, workers=None, processes=False, cache=None):
         vprint('Merging and constructing')
-        refs = self.read_vars()
-        self.metadata['refs'] = {**self.metadata['refs'], **refs}
+        refs = self.read_vars(workers=workers, processes=processes, cache=cache)
+        self.metadata['refs'] = {**self.metadata['refs'], **self.inline.refs(), **refs}
+
+    @traced('process')
+    def process(self, stream=False, fmt='json', workers=None, verify=None, shard=None):
+        """
+        Pack the kerchunk file into the store.
 
-    def process(self):
+        fmt is the pack format, 'json', binary 'kpk' or netCDF 'nc'. shard
+        splits each variable into packs of that many leading chunk indices,
+        so loads of a time range only read the packs covering it.
+        """
+        if fmt not in ('json', 'kpk', 'nc'):
+            raise ValueError(f'Unknown pack format {fmt}')
+        if shard is not None and (not isinstance(shard, int) or shard < 1):
+            raise ValueError(f'Shard size must be a positive number of chunks, not {shard}')
+        self.fmt = fmt
+        self.shard = shard
         self.make_store()
-        refs = self.get_kfile()
-        self.deconstruct(refs)
-        self.write_vars()
+        refs = None
+        if stream:
+            self.deconstruct_stream()
+        else:
+            refs = self.get_kfile()
+            self.deconstruct(refs)
+            if not verify:
+                del refs
+                refs = None
+        self.write_vars(workers=workers)
         self.write_meta()
+        vprint(f'Peak RSS: {peak_rss():.1f} MB')
         vprint('Success')
+        if verify:
+            # Checked against the refs already parsed, streamed files are read again
+            return self.verify_meta(sample=None if verify is True else verify, original=refs)
 
-    def cache_construct(self):
-        f = open(self.kfile.replace('.json','_rec.json'),'w')
-        f.write(json.dumps(self.metadata, cls=NumpyArrayEncoder))
-        f.close()
+    def leading_dim(self, var):
+        # Name of a variable's first dimension from its .zattrs
+        zattrs = load_attrs(self.metadata['refs'].get(f'{var}/.zattrs')) or {}
+        dims = zattrs.get('_ARRAY_DIMENSIONS') or [None]
+        return dims[0]
 
-    def verify_meta(self):
-        vprint('Attempting Verification')
-        original = self.get_kfile()
-        translated = self.metadata
-        outcount = 0
-        for key in original.keys():
-            if key != 'refs':
-                if translated[key] == original[key]:
-                    outcount += 1
-            else:
-                outcount += 1
-        vprint(f'Metadata Accuracy: {outcount*100/len(original.keys()):.1f} %')
+    def extend_zarray(self, key, zarray):
+        # Grow the leading dimension of a stored .zarray by that of another
+        stored = self.metadata['refs'].get(key)
+        old = load_attrs(stored)
+        if old is None:
+            raise ValueError(f'{key} not found in store {self.store}')
+        if list(old['chunks']) != list(zarray['chunks']) or old['shape'][1:] != zarray['shape'][1:]:
+            raise ValueError(f'{key} chunks or shape do not match the new refs')
+        if old['shape'][0] % old['chunks'][0]:
+            raise ValueError(f'{key} ends in a partial chunk, new chunks would not align')
+        nchunks = old['shape'][0] // old['chunks'][0]
+        old['shape'] = [old['shape'][0] + zarray['shape'][0]] + old['shape'][1:]
+        self.metadata['refs'][key] = json.dumps(old) if isinstance(stored, str) else old
+        return nchunks
+
+    def append_coord(self, dim, refs):
+        # Extend the leading coordinate with the values in refs
+        old = load_attrs(self.metadata['refs'].get(f'{dim}/.zarray'))
+        new = load_attrs(refs.get(f'{dim}/.zarray'))
+        if old is None or new is None:
+            vprint(f'No {dim} coordinate refs to extend')
+            return
+        oldattrs = load_attrs(self.metadata['refs'].get(f'{dim}/.zattrs')) or {}
+        newattrs = load_attrs(refs.get(f'{dim}/.zattrs')) or {}
+        for attr in ('units', 'calendar'):
+            if oldattrs.get(attr) != newattrs.get(attr):
+                raise ValueError(f'{dim} {attr} differ: {oldattrs.get(attr)} and {newattrs.get(attr)}')
+        if old['dtype'] != new['dtype']:
+            raise ValueError(f'{dim} dtype differs: {old["dtype"]} and {new["dtype"]}')
+
+        chunkrefs = {k.split('/')[1]: v for k, v in refs.items() if k.startswith(f'{dim}/') and k[len(dim)+1] != '.'}
+        stored = self.metadata['refs'].get(f'{dim}/0')
+        single = old['chunks'] == old['shape'] and new['chunks'] == new['shape']
+        plain = not any(z.get('compressor') or z.get('filters') for z in (old, new))
+        if single and plain and isinstance(stored, str) and isinstance(chunkrefs.get('0'), str):
+            # Single uncompressed inline chunks are joined into one
+            data = inline_bytes(stored) + inline_bytes(chunkrefs['0'])
+            old['shape'] = old['chunks'] = [old['shape'][0] + new['shape'][0]]
+            zarray = self.metadata['refs'][f'{dim}/.zarray']
+            self.metadata['refs'][f'{dim}/.zarray'] = json.dumps(old) if isinstance(zarray, str) else old
+            self.metadata['refs'][f'{dim}/0'] = 'base64:' + base64.b64encode(data).decode()
+            return
 
-        incount = 0
-        for key in original['refs'].keys():
-            p1 = str(translated['refs'][key][1]) == str(original['refs'][key][1])
-            p2 = str(translated['refs'][key][2]) == str(original['refs'][key][2])
-            if p1 and p2:
-                incount += 1
-        vprint(f'Refs Accuracy: {incount*100/len(original["refs"].keys()):.1f} %')
+        if old['chunks'] != new['chunks'] or old['shape'][0] % old['chunks'][0]:
+            raise ValueError(f'{dim} coordinate refs cannot be joined, only whole chunks or uncompressed inline values')
+        # Whole chunks, new refs follow on with shifted chunk indices
+        nchunks = self.extend_zarray(f'{dim}/.zarray', new)
+        for key, ref in chunkrefs.items():
+            index = key.split('.')
+            index[0] = str(int(index[0]) + nchunks)
+            self.metadata['refs'][f'{dim}/' + '.'.join(index)] = ref
 
+    def append(self, refs, stream=False):
+        """
+        Extend the store with refs for new files only.
 
-    def load(self, cache=None, verify=None):
+        refs is a kerchunk file or dict for the new files, with chunk keys
+        starting from zero along the leading (time) dimension. Only the new
+        chunks are packed, against each variable's stored msize and moffset,
+        and the files list, .zarray shapes and leading coordinate are
+        extended in meta.json. stream only applies to a kerchunk file, a
+        dict is already in memory.
+        """
         self.read_meta()
-        self.construct()
+        f = open(os.path.join(self.store, 'meta.json'),'r')
+        meta = json.load(f)
+        f.close()
+        # Coordinates may be held in the sidecar
+        self.metadata['refs'].update(self.inline.refs())
+
+        new = Converter(refs if isinstance(refs, str) else None, None, store=self.store)
+        if not isinstance(refs, str):
+            new.deconstruct(refs)
+        elif stream:
+            new.deconstruct_stream()
+        else:
+            new.deconstruct(new.get_kfile())
+        missing = sorted(set(new.vars) - set(self.vars))
+        if missing:
+            raise ValueError(f'Variables {missing} are not in store {self.store}')
+        vprint(f'Appending {sum(v.fcounter for v in new.vars.values())} chunks from {len(new.files)} files')
+
+        # Everything is checked and extended in memory before the store is written
+        # New paths already in the store keep their index
+        files = list(expand_paths(meta['files']))
+        index = {}
+        for i, name in enumerate(files):
+            index.setdefault(name, i)
+        filemap = []
+        for name in new.files:
+            if name not in index:
+                index[name] = len(files)
+                files.append(name)
+            filemap.append(index[name])
+        dims = set()
+        for name, var in new.vars.items():
+            zarray = load_attrs(new.metadata['refs'].get(f'{name}/.zarray'))
+            nlead = None
+            if zarray is not None:
+                self.extend_zarray(f'{name}/.zarray', zarray)
+                nlead = new.get_grid(name)[0]
+            self.vars[name].append_gen(var, nlead=nlead, filemap=filemap)
+            dims.add(self.leading_dim(name))
+        for dim in dims - {None}:
+            self.append_coord(dim, new.metadata['refs'])
+
+        for var in self.vars.values():
+            for part in [var] + var.parts():
+                part.fileset = files
+        for name in new.vars:
+            var = self.vars[name]
+            var.write()
+            meta['vars'][name] = var.get_entry()
+            meta.setdefault('gfactor', {})[name] = round(var.gfactor(), 4)
+            if isinstance(var, ShardedVariable):
+                meta['shards'][name] = var.get_index()
+
+        meta['files'] = compress_paths(files)
+        meta['refs'], payloads = split_inline(self.metadata['refs'])
+        meta['inline'] = write_inline(self.store, payloads)
+        self.inline = InlineRefs(self.store, meta['inline'])
+        f = open(os.path.join(self.store, 'meta.json'), 'w')
+        f.write(json.dumps(meta))
+        f.close()
+        vprint('Success')
+
+    def verify_meta(self, sample=None, original=None):
+        # Compare the store with the original kerchunk refs, or the kerchunk file, see verify.py
+        from verify import verify_store
+        vprint('Attempting Verification' + (f' of {sample} chunks per variable' if sample else ''))
+        report = verify_store(self.store, self.kfile if original is None else original, sample=sample)
+
+        meta = report['metadata']
+        vprint(f"Metadata Accuracy: {(meta['checked']-meta['mismatches'])*100/max(meta['checked'],1):.1f} %")
+        checked = sum(r.get('checked', r['chunks']) for r in report['vars'].values())
+        wrong = sum(r['missing'] + r['mismatches'] for r in report['vars'].values())
+        vprint(f'Refs Accuracy: {(checked-wrong)*100/max(checked,1):.1f} %')
+        for key in meta['first']:
+            vprint(f'Metadata mismatch {key}')
+        for result in report['vars'].values():
+            for entry in result['first']:
+                vprint(f"Mismatch {entry['key']}: original {entry['original']}, store {entry['store']}")
+        return report
+
+    def set_leads(self, window):
+        # Leading chunk range of each variable covering a slice along its first dimension
+        for name in self.vars:
+            zarray = load_attrs(self.metadata['refs'].get(f'{name}/.zarray'))
+            if zarray is None:
+                raise ValueError(f'No .zarray for {name}, cannot select along its leading dimension')
+            start, stop, _ = window.indices(zarray['shape'][0])
+            chunk = zarray['chunks'][0]
+            self.leads[name] = (start // chunk, -(-stop // chunk))
+
+    @traced('load', lambda a, k, r: {'refs': len(r['refs'])})
+    def load(self, cache=None, verify=None, workers=None, processes=False, variables=None, time=None):
+        """
+        Rebuild the kerchunk refs from the store.
+
+        variables limits the chunk refs to those variables, refs for other
+        packed variables are dropped. time is a slice along the leading
+        dimension, only chunks overlapping it are unpacked and reads outside
+        it return the fill value. Coordinate and other metadata refs are
+        always kept so the dataset still opens.
+
+        cache reuses unpacked tables between loads, True for the process-wide
+        cache.TABLES or a cache.TableCache. verify is True to check every
+        ref against the original kerchunk file, or a number of chunks per
+        variable to sample.
+        """
+        if verify and (variables is not None or time is not None):
+            raise ValueError('Verification needs a full load, without variables or time')
+        self.read_meta(variables=variables)
+        if time is not None:
+            self.set_leads(time)
+        if cache is True:
+            cache = TABLES
+        elif not isinstance(cache, TableCache):
+            cache = None
+        self.construct(workers=workers, processes=processes, cache=cache)
         vprint('Success')
-        if cache:
-            self.cache_construct()
         if verify:
-            self.verify_meta()
+            self.verify_meta(sample=None if verify is True else verify)
         return self.metadata
\ No newline at end of file
@@ -1,17 +1,45 @@
-f1 = '/gws/nopw/j04/esacci_portal/kerchunk/kfiles/esacci12.json'
-f2 = 'extracted.json'
+# Diffs.py
 
-with open(f1) as f:
-    c1 = f.readlines()[0]
+# Report the differences between a kerchunk file and its store
+#   python diffs.py <kfile> <store> [--sample N] [--context N] [--json]
 
-with open(f2) as f:
-    c2 = f.readlines()[0]
+import argparse
+import json
 
-print(len(c1), len(c2))
+from verify import verify_store
 
-for x in range(int(len(c1)/100)):
-    if c1[x*100:(x+1)*100] != c2[x*100:(x+1)*100]:
-        print(x)
-        print(c1[x*100:(x+1)*100])
-        print(c2[x*100:(x+1)*100])
-        x=input()
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description='Differences between a kerchunk file and a .kst store')
+    parser.add_argument('kfile')
+    parser.add_argument('store')
+    parser.add_argument('--sample', type=int, default=None, help='random chunks checked per variable')
+    parser.add_argument('--context', type=int, default=10, help='mismatches listed per variable')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='print the full report as json')
+    args = parser.parse_args()
+
+    report = verify_store(args.store, args.kfile, sample=args.sample, context=args.context, seed=args.seed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    meta = report['metadata']
+    print(f"metadata: {meta['checked']} checked, {meta['mismatches']} differ")
+    for key in meta['first']:
+        print(f'  {key}')
+    for var, result in report['vars'].items():
+        checked = result.get('checked', result['chunks'])
+        print(f"{var}: {checked} checked, {result['mismatches']} differ, {result['missing']} missing, "
+              f"{result.get('extra', 0)} extra")
+        for entry in result['first']:
+            print(f"  {entry['key']}")
+            print(f"    original {entry['original']}")
+            print(f"    store    {entry['store']}")
+            if 'previous' in entry:
+                print(f"    previous {entry['previous']}")
+    if 'count' in report:
+        print(f"refs: {report['count']['original']} original, {report['count']['stored']} stored")
+    print('OK' if report['ok'] else 'DIFFERENT')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Fetch.py
+
+# Concurrent byte range fetching for http(s) chunk refs
+#  - One asyncio loop per Fetcher, run in a background thread so the
+#    blocking fsspec/zarr calls can hand it whole batches
+#  - A pooled aiohttp session reuses connections across batches
+#  - Requests to each host are capped by a semaphore
+#  - Failed requests are retried with exponential backoff
+#  - aiohttp is only needed once an http(s) batch is fetched
+
+import asyncio
+import atexit
+import os
+import threading
+
+from urllib.parse import urlsplit
+
+# Status codes worth another attempt
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+class FetchError(OSError):
+    pass
+
+class Fetcher:
+    """
+    Fetch many (url, start, end) byte ranges concurrently.
+
+    per_host caps the requests open to any one host, retries/backoff set
+    how often and how patiently a failed request is tried again (backoff
+    doubles each attempt). Extra keyword arguments go to the
+    aiohttp.ClientSession, e.g. headers or auth.
+    """
+    def __init__(self, per_host=32, retries=3, backoff=0.1, timeout=60, **session_kwargs):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session_kwargs = session_kwargs
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.limits = {}
+        self.pid = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.bytes = 0
+
+    def start(self):
+        # Background loop, started on first use and again in forked children
+        with self.lock:
+            if self.pid != os.getpid():
+                self.loop, self.session, self.limits = None, None, {}
+                self.pid = os.getpid()
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    async def get_session(self):
+        if self.session is None:
+            import aiohttp
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.per_host)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, **self.session_kwargs)
+        return self.session
+
+    def limit(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.per_host)
+        return self.limits[host]
+
+    async def get_range(self, url, start, end):
+        import aiohttp
+        session = await self.get_session()
+        headers = {'Range': f'bytes={start}-{end-1}'}
+        for attempt in range(self.retries + 1):
+            retry = None
+            async with self.limit(url):
+                self.requests += 1
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 404:
+                            raise FileNotFoundError(url)
+                        if response.status in RETRY_STATUS:
+                            retry = FetchError(f'HTTP {response.status} for {url}')
+                        elif response.status not in (200, 206):
+                            raise FetchError(f'HTTP {response.status} for {url}')
+                        else:
+                            data = await response.read()
+                            if response.status == 200:
+                                # Server ignored the range
+                                data = data[start:end]
+                            self.bytes += len(data)
+                            return data
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    retry = err
+            if attempt == self.retries:
+                raise retry
+            self.retried += 1
+            await asyncio.sleep(self.backoff * 2**attempt)
+
+    async def gather(self, urls, starts, ends):
+        tasks = [self.get_range(u, s, e) for u, s, e in zip(urls, starts, ends)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def fetch(self, urls, starts, ends):
+        """
+        Bytes for each range in order, or the exception it failed with.
+        """
+        if not urls:
+            return []
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.gather(urls, starts, ends), self.loop)
+        return future.result()
+
+    def close(self):
+        if self.loop is None or self.pid != os.getpid():
+            return
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.limits = {}
+
+    def stats(self):
+        return {'requests': self.requests, 'retried': self.retried, 'bytes': self.bytes}
+
+# Shared by every store mapper in the process
+FETCHER = Fetcher()
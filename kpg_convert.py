@@ -14,12 +14,19 @@ from kerchunk.utils import consolidate
 
 import base64
 import json
+import sys
 import jinja2
 import numpy as np
 from scipy import stats
 
+from operator import itemgetter
+
 from datetime import datetime
 
+from convert import format_keys, split_keys
+from paths import compress_paths, expand_paths
+from tracing import traced
+
 def open_kerchunk_json():
     tdict = {}
     return tdict
@@ -87,6 +94,71 @@ def access_reference(freference, time_dim=1):
                 ndims.append(1)
     return variables, ndims
 
+def access_kerchunk(out, time_dim=None):
+    """
+    Offline equivalent of access_reference using only the kerchunk refs.
+
+    Chunk structure comes from each variable's .zarray (shape, chunks),
+    so no source file is opened. A variable whose chunks match its shape
+    is treated as contiguous. time_dim overrides the number of chunks
+    along the first dimension, by default it is taken from the shape.
+    """
+    print('[INFO] Accessing Kerchunk Metadata')
+
+    # These dimensions are always ignored when retrieving variables
+    ignore = ['lat','lon','latitude','longitude','time']
+    refs = out['refs']
+    maxdims = 0
+    checkvars, zarrays = {}, {}
+
+    for key in refs:
+        var, _, meta = key.partition('/')
+        if meta != '.zarray' or var in ignore:
+            continue
+        zarray = refs[key]
+        if isinstance(zarray, str):
+            zarray = json.loads(zarray)
+        zarrays[var] = zarray
+
+        shape, chunks = zarray['shape'], zarray['chunks']
+        # Determine number of chunked dims per variable
+        if list(chunks) != list(shape):
+            ndims = 0
+            for dim in chunks:
+                if int(dim) > 1:
+                    ndims += 1
+            ckey = ndims
+            if maxdims < ndims:
+                maxdims = ndims
+        else:
+            ckey = 'contiguous'
+
+        # Collect variables in dict by number of chunked dims.
+        if ckey in checkvars:
+            checkvars[ckey].append(var)
+        else:
+            checkvars[ckey] = [var]
+
+    # Check for no internal chunking
+    if maxdims == 0:
+        variables = checkvars['contiguous']
+    else:
+        variables = False
+        # Find highest number of chunks and collect variables
+        while maxdims > 0 and not variables:
+            if maxdims in checkvars:
+                variables = checkvars[maxdims]
+            maxdims -= 1
+
+    shape = zarrays[variables[0]]['shape']
+    chunks = zarrays[variables[0]]['chunks']
+    # Number of chunks along each dimension, including any partial edge chunk
+    ndims = [-(-int(size) // int(chunk)) for size, chunk in zip(shape, chunks)]
+    if time_dim:
+        ndims[0] = time_dim
+    return variables, ndims
+
+@traced('install_generators', lambda a, k, r: {'variables': len(a[1])})
 def install_generators(out, variables, dims):
     """
     Pack chunk arrays into custom generators.
@@ -94,63 +166,78 @@ def install_generators(out, variables, dims):
     Single chunk reference pass followed by analysis of lengths and offsets
     Use of numpy arrays rather than python lists to improve performance.
     """
-    
-    def update(countdim, dims, index):
-        countdim[index] += 1
-        if countdim[index] >= dims[index]:
-            countdim[index] = 0
-            countdim = update(countdim, dims, index-1)
-        return countdim
 
     refs = out['refs']
-    
-    countdim = [0 for dim in dims]
-    countdim[-1] = -1
-    maxdims = [dim-1 for dim in dims]
-    chunkindex = 0
-    files, skipchunks = [], {}
-    filepointer = 0
+    lv = len(variables)
+    chunkindex = int(np.prod(dims)) * lv
+
     ## Stage 1 pass ##
-    # - collect skipchunks
-    # - collect files
-    # - collect offsets and lengths for determining lengths
+    # - collect each variable's chunk keys and parse them in bulk
+    # - place lengths, offsets and files on the chunk grid at once
+    # - skipchunks are the grid positions left empty
 
     print('[INFO] Installing Generator')
-    lengths, offsets = [],[]
-    while countdim != maxdims:
-        countdim = update(countdim, dims, -1)
-        # Iterate over dimensions and variables, checking each reference in turn
-        for vindex, var in enumerate(variables):
-            key = var + '/' + '.'.join(str(cd) for cd in countdim)
-            # Compile Skipchunks
-            if key not in refs:
-                try:
-                    skipchunks['.'.join(str(cd) for cd in countdim)][vindex] = 1
-                except:
-                    skipchunks['.'.join(str(cd) for cd in countdim)] = [0 for v in variables]
-                    skipchunks['.'.join(str(cd) for cd in countdim)][vindex] = 1
-                try:
-                    offsets.append(offsets[-1] + lengths[-1])
-                except:
-                    offsets.append(0)
-                lengths.append(0)
-            else:
-                # Compile offsets and lengths
-                lengths.append(refs[key][2])
-                offsets.append(refs[key][1])
-                
-                # Determine files collection
-                filename = refs[key][0]
-                if len(files) == 0:
-                    files.append([-1, filename])
-                if filename != files[filepointer][1]:
-                    files[filepointer][0] = chunkindex-1
-                    filepointer += 1
-                    files.append([chunkindex, filename])
-                del out['refs'][key]
-            chunkindex += 1
+    lengths  = np.zeros(chunkindex, dtype=int)
+    offsets  = np.zeros(chunkindex, dtype=int)
+    filecode = np.full(chunkindex, -1, dtype=int)
+    codes, delkeys = {}, []
+    for vindex, var in enumerate(variables):
+        prefix = var + '/'
+        keys = [key for key in refs if key.startswith(prefix)]
+        for meta in ('.zarray', '.zattrs'):
+            if prefix + meta in refs:
+                keys.remove(prefix + meta)
+        coords, keys = parse_chunk_keys(keys, len(prefix), len(dims))
+        if not keys:
+            continue
+        ingrid = np.all((coords >= 0) & (coords < np.array(dims)), axis=1)
+        if not ingrid.all():
+            keys = [key for key, inside in zip(keys, ingrid) if inside]
+            coords = coords[ingrid]
+        positions = np.ravel_multi_index(tuple(coords.T), dims) * lv + vindex
+
+        vrefs = list(map(refs.__getitem__, keys))
+        lengths[positions] = np.fromiter(map(itemgetter(2), vrefs), dtype=int, count=len(vrefs))
+        offsets[positions] = np.fromiter(map(itemgetter(1), vrefs), dtype=int, count=len(vrefs))
+
+        # Files only need comparing where the filename changes
+        names = np.array(list(map(itemgetter(0), vrefs)), dtype=object)
+        heads = np.concatenate(([0], np.flatnonzero(names[1:] != names[:-1]) + 1))
+        headcodes = [codes.setdefault(names[head], len(codes)) for head in heads]
+        filecode[positions] = np.repeat(headcodes, np.diff(heads, append=len(names)))
+        delkeys += keys
+
+    filenames = list(codes)
+    present = filecode >= 0
+    for key in delkeys:
+        del out['refs'][key]
+
+    # Missing chunks continue on from the previous chunk with zero length
+    previous = np.maximum.accumulate(np.where(present, np.arange(chunkindex), -1))[~present]
+    ends = offsets + lengths
+    offsets[~present] = np.where(previous >= 0, ends[np.maximum(previous, 0)], 0)
+
+    # Files hold the last chunk index of each run of a single file
+    positions = np.flatnonzero(present)
+    pcodes = filecode[positions]
+    changes = np.flatnonzero(pcodes[1:] != pcodes[:-1]) + 1
+    files = [
+        [int(positions[nxt]) - 1, filenames[pcodes[run]]]
+        for run, nxt in zip(np.concatenate(([0], changes)), changes)
+    ]
     # Set final file chunk index
-    files[-1][0] = chunkindex
+    files.append([chunkindex, filenames[pcodes[changes[-1] if len(changes) else 0]]])
+    # Run ends alongside the compressed paths of each run
+    files = {
+        'ends': [end for end, name in files],
+        'paths': compress_paths([name for end, name in files]),
+    }
+
+    skipchunks = {}
+    missing = ~present.reshape(-1, lv)
+    rows = np.flatnonzero(missing.any(axis=1))
+    for row, coords in zip(rows, np.transpose(np.unravel_index(rows, dims))):
+        skipchunks['.'.join(str(cd) for cd in coords)] = [int(m) for m in missing[row]]
     
     lengths = np.array(lengths, dtype=int)
     offsets = np.array(offsets, dtype=int)
@@ -224,6 +311,16 @@ def install_generators(out, variables, dims):
 
     return out
 
+def parse_chunk_keys(keys, skip, ndims):
+    """
+    Parse chunk keys to an (n, ndims) coordinate array in one pass.
+
+    Keys are sliced from position skip (after 'var/'). Anything that is
+    not an ndims-part chunk key is dropped, returns coords and the kept keys.
+    """
+    coords, valid = split_keys(keys, ndims, skip=skip)
+    return coords, [key for key, v in zip(keys, valid) if v]
+
 def get_coords(count, dims):  
     """
     Assemble key variable-wise rather than chunk-wise.
@@ -245,73 +342,107 @@ def get_coords(count, dims):
     return '.'.join(key)
 
 
-def fast_write_files_keys(files, vars, dims, refnum):
-    tot = 0
-    fcount = 0
-    nfiles, keys = [],[]
-    for ref in range(int(refnum/len(vars))):
-        t0 = datetime.now()
-        coords = get_coords(ref, dims)
-        tot += (datetime.now()-t0).total_seconds()
-        if ref > files[fcount][0]:
-            fcount += 1
-        for v in vars:
-            nfiles.append(files[fcount][1])
-            keys.append(f'{vars}/{coords}')
-    return nfiles, keys
+class GeneratorIndex:
+    """
+    Random access to the chunk references held in an out['gen'] generator.
 
+    Sizes and the cumulative size/gap offsets are built once as arrays,
+    after which any chunk resolves with a ravel and a binary search over
+    the file boundaries.
+    """
+    def __init__(self, gen):
+        self.variables = list(gen['variables'])
+        self.dims      = [int(dim) for dim in gen['dims']]
+        # Last chunk index covered by each file, older generators list [end, name] pairs
+        if isinstance(gen['files'], dict):
+            self.filenames = expand_paths(gen['files']['paths'])
+            self.fileends  = np.array(gen['files']['ends'], dtype=int)
+        else:
+            self.filenames = [f[1] for f in gen['files']]
+            self.fileends  = np.array([int(f[0]) for f in gen['files']], dtype=int)
+
+        lv = len(self.variables)
+        stop = int(gen['dimensions']['i']['stop'])
+        sizes = np.tile(np.array(gen['lengths'], dtype=int), stop // lv)
+
+        # Skipped chunks were packed with zero length
+        if gen['skipchunks']:
+            coords, keys = parse_chunk_keys(list(gen['skipchunks']), 0, len(self.dims))
+            flags = np.array([gen['skipchunks'][key] for key in keys], dtype=bool)
+            base = np.ravel_multi_index(tuple(coords.T), self.dims) * lv
+            sizes[(base[:, None] + np.arange(lv))[flags]] = 0
+
+        sizes[np.array(gen['unique']['ids'], dtype=int)] = gen['unique']['lengths']
+        gaps = np.zeros(stop, dtype=int)
+        gaps[np.array(gen['gaps']['ids'], dtype=int)] = gen['gaps']['lengths']
+
+        # offset[i] = offset[i-1] + size[i-1] + gap[i]
+        self.sizes = sizes
+        self.offsets = np.cumsum(gaps) + int(gen['start'])
+        self.offsets[1:] += np.cumsum(sizes)[:-1]
+
+    def positions(self, var, coords):
+        # Flat chunk indices for an (n, ndims) array of grid coordinates
+        coords = np.atleast_2d(np.asarray(coords, dtype=int))
+        lv = len(self.variables)
+        return np.ravel_multi_index(tuple(coords.T), self.dims) * lv + self.variables.index(var)
+
+    def lookup(self, var, coords):
+        """
+        Reference [file, offset, size] for one chunk, or None if it was skipped.
+
+        coords may be a sequence of grid indices or a chunk key like '3.0.1'.
+        """
+        if isinstance(coords, str):
+            coords = [int(c) for c in coords.split('.')]
+        pos = int(self.positions(var, coords)[0])
+        if self.sizes[pos] == 0:
+            return None
+        findex = int(np.searchsorted(self.fileends, pos))
+        return [self.filenames[findex], int(self.offsets[pos]), int(self.sizes[pos])]
+
+    def lookup_many(self, var, coords):
+        """
+        Bulk lookup for an (n, ndims) array of grid coordinates.
+
+        Returns (files, offsets, sizes) arrays, files is None for skipped chunks.
+        """
+        pos = self.positions(var, coords)
+        sizes = self.sizes[pos]
+        findex = np.searchsorted(self.fileends, pos)
+        findex[sizes == 0] = len(self.filenames)
+
+        # Paths are only built for the files in use
+        names = np.empty(len(self.filenames) + 1, dtype=object)
+        used = np.unique(findex[sizes != 0])
+        names[used] = [self.filenames[i] for i in used.tolist()]
+        return names[findex], self.offsets[pos], sizes
+
+    def unpack(self):
+        # Expand every present chunk into a kerchunk refs dict
+        refs = {}
+        gidx = np.arange(int(np.prod(self.dims)))
+        grid = np.transpose(np.unravel_index(gidx, self.dims))
+        for vindex, var in enumerate(self.variables):
+            files, offsets, sizes = self.lookup_many(var, grid)
+            present = sizes != 0
+            refs.update(zip(
+                format_keys(gidx[present], self.dims, prefix=f'{var}/').tolist(),
+                map(list, zip(files[present].tolist(), offsets[present].tolist(), sizes[present].tolist()))
+            ))
+        return refs
+
+@traced('fast_unpack', lambda a, k, r: {'refs': len(r)})
 def fast_unpack(out):
     print('[INFO] Unpacking Generator')
-    refnum = int(out['gen']['dimensions']['i']['stop'])
-    refs_per_var = int(refnum/len(out['gen']['lengths']))
-    gaps = np.zeros((refnum,))
-    sizes = np.zeros((0,))
-    for vindex in range(len(out['gen']['lengths'])):
-
-        vsizes = np.zeros((refs_per_var,))
-        vsizes[:] = out['gen']['lengths'][vindex]
-        sizes = np.concatenate((sizes, vsizes))
-
-    uniqueids     = np.array(out['gen']['unique']['ids'])
-    uniquelengths = np.array(out['gen']['unique']['lengths'])
-
-    gapids        = np.array(out['gen']['gaps']['ids'])
-    gaplengths    = np.array(out['gen']['gaps']['lengths'])
-
-    gaps[gapids] = gaplengths
-
-    sizes[uniqueids] = uniquelengths
-    cs_sizes = np.cumsum(sizes)
-    gs_sizes = np.cumsum(gaps)
-    offsets = cs_sizes + gs_sizes
-    offsets = np.roll(offsets, 1)
-    offsets[0] = 0
-    offsets += int(out['gen']['start'])
-    
-    base = np.transpose([offsets, sizes])
-
-    newsize = len(sizes)
-    pairs = np.reshape(base, (newsize, 2))
-    files = out['gen']['files']
-    vars = out['gen']['variables']
-    dims = out['gen']['dims']
-
-    crange = (newsize-1000, newsize-900)
-
-
-    nfiles, keys = fast_write_files_keys(files, vars, dims, crange)
-    
-    tdict = {}
-    for x in range(crange):
-        tdict[keys[x]] = [nfiles[x], pairs[x][0], pairs[x][1]]
-    
-
+    index = GeneratorIndex(out['gen'])
+    refs = index.unpack()
     print('[INFO] Generator Unpacked')
-    return None
+    return refs
 
-def main():
+def main(offline=False):
     # Open kerchunk file as out
-    # Access reference with freference file
+    # Access reference with freference file, or offline from the refs alone
     test_kerchunk = 'kc-indexes/ESA/e1000_og.json'
     rfile = "/neodc/esacci/land_surface_temperature/data/AQUA_MODIS/L3C/0.01/v3.00/daily/2002/07/04/ESACCI-LST-L3C-LST-MODISA-0.01deg_1DAILY_NIGHT-20020704000000-fv3.00.nc"
     t0 = datetime.now()
@@ -322,7 +453,10 @@ def main():
     print(f'[INFO] Opened kerchunk file - {(datetime.now()-t0).total_seconds()}s')
     tnow = datetime.now()
 
-    variables, ndims = access_reference(rfile, time_dim=1000)
+    if offline:
+        variables, ndims = access_kerchunk(out)
+    else:
+        variables, ndims = access_reference(rfile, time_dim=1000)
     print(f'[INFO] Accessed Reference - {(datetime.now()-tnow).total_seconds()}s')
     tnow = datetime.now()
     out = install_generators(out, variables, ndims)
@@ -335,5 +469,6 @@ def main():
         f.write(json.dumps(out))
         f.close()
     print('Success')
-    
-main()
\ No newline at end of file
+
+if __name__ == '__main__':
+    main(offline='--offline' in sys.argv)
\ No newline at end of file
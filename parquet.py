@@ -0,0 +1,172 @@
+# Parquet.py
+
+# Move stores to and from kerchunk's Parquet references
+#  - fsspec's LazyReferenceMapper keeps .zarray/.zattrs metadata in one
+#    .zmetadata file and chunk refs as <var>/refs.<k>.parq, record_size
+#    chunks per file in C order
+#  - to_parquet writes a store one pack (or shard) at a time, full parquet
+#    records are written out as they fill
+#  - from_parquet reads one record file at a time into the same per-ref
+#    ingest the streaming kerchunk json reader uses
+#  - pandas and pyarrow or fastparquet are only needed here
+
+import base64
+import json
+import math
+import os
+
+import numpy as np
+
+from convert import Converter, format_keys, vprint, zarray_grid
+from tracing import traced
+
+def parquet_engine(engine=None):
+    # Parquet engine to use, pyarrow if installed, else fastparquet
+    from importlib.util import find_spec
+    if engine is not None:
+        return engine
+    for name in ('pyarrow', 'fastparquet'):
+        if find_spec(name) is not None:
+            return name
+    raise ImportError('Parquet references need pyarrow or fastparquet installed')
+
+def chunk_grid(zarray):
+    # Chunks along each dimension, as LazyReferenceMapper numbers them
+    return zarray_grid(zarray) or [1]
+
+# Bytes left as plain text in inline refs, anything else is base64 encoded
+TEXT = bytes(range(32, 127)) + b'\t\n\r'
+
+def raw_ref(data):
+    # Inline ref string for raw bytes, as kerchunk writes it in json
+    if not data.translate(None, TEXT) and not data.startswith(b'base64:'):
+        return data.decode('ascii')
+    return 'base64:' + base64.b64encode(data).decode()
+
+def is_meta(key):
+    # Keys LazyReferenceMapper keeps in .zmetadata rather than in records
+    return key.startswith('.z') or '/.z' in key or '/' not in key
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+def iter_parquet(mapper):
+    """
+    (key, ref) for every reference in a LazyReferenceMapper.
+
+    Metadata comes from .zmetadata, chunk refs are read a record file at a
+    time with their keys worked out from the row numbers. Rows with neither
+    a path nor raw data are chunks that were never written.
+    """
+    for key, value in mapper.zmetadata.items():
+        yield key, value
+    for field in sorted(mapper.listdir()):
+        zarray = mapper.zmetadata.get(f'{field}/.zarray')
+        if zarray is None:
+            continue
+        grid = chunk_grid(zarray)
+        nchunks = int(np.prod(grid))
+        for record in range(math.ceil(nchunks / mapper.record_size)):
+            refs = mapper.open_refs(field, record)
+            if refs is None:
+                continue
+            first = record * mapper.record_size
+            rows = min(mapper.record_size, nchunks - first)
+            keys = format_keys(np.arange(first, first + rows), grid, prefix=f'{field}/')
+
+            paths = refs['path'][:rows] if 'path' in refs else [None] * rows
+            raws = refs['raw'][:rows] if 'raw' in refs else [None] * rows
+            offsets = refs['offset'][:rows].tolist() if 'offset' in refs else [0] * rows
+            sizes = refs['size'][:rows].tolist() if 'size' in refs else [0] * rows
+            for key, path, raw, offset, size in zip(keys.tolist(), paths, raws, offsets, sizes):
+                if not is_null(raw):
+                    yield key, raw_ref(bytes(raw))
+                elif is_null(path):
+                    continue
+                elif offset == 0 and size == 0:
+                    # Whole file ref
+                    yield key, [path]
+                else:
+                    yield key, [path, offset, size]
+
+class ParquetConverter(Converter):
+    """
+    Converter fed from Parquet references instead of a kerchunk file.
+
+    Only the streaming ingest applies, process(stream=True) is the way to
+    pack one.
+    """
+    def __init__(self, root, outpath, store=None, engine=None, storage_options=None):
+        if store is None:
+            name = root.rstrip('/').split('/')[-1]
+            for ext in ('.parquet', '.parq'):
+                if name.endswith(ext):
+                    name = name[:-len(ext)]
+            store = os.path.join(outpath, name) + '.kst'
+        super().__init__(root, outpath, store=store)
+        self.engine = parquet_engine(engine)
+        self.storage_options = storage_options or {}
+
+    def mapper(self):
+        import fsspec
+        from fsspec.implementations.reference import LazyReferenceMapper
+        fs, root = fsspec.core.url_to_fs(self.kfile, **self.storage_options)
+        return LazyReferenceMapper(root, fs=fs, engine=self.engine)
+
+    def get_kfile(self):
+        raise ValueError('Parquet references are read with process(stream=True)')
+
+    @traced('deconstruct_parquet', lambda a, k, r: {'variables': len(a[0].vars)})
+    def deconstruct_stream(self, blocksize=None):
+        vprint('Streaming parquet references')
+        self.metadata = {'version': 1, 'refs': {}}
+        for key, ref in iter_parquet(self.mapper()):
+            if isinstance(ref, dict):
+                ref = json.dumps(ref)
+            self.add_ref(key, ref)
+
+@traced('to_parquet', lambda a, k, r: {'variables': len(r)})
+def to_parquet(store, root, record_size=10000, engine=None, storage_options=None):
+    """
+    Write a .kst store as Parquet references under root.
+
+    record_size is the number of chunk refs per parquet file. Packs are
+    unpacked one at a time, so only one pack's refs and the unfinished
+    records are held at once. Returns {variable: chunks written}.
+    """
+    from fsspec.implementations.reference import LazyReferenceMapper
+    from unpack import KStoreRefs
+
+    refs = KStoreRefs(store)
+    out = LazyReferenceMapper.create(
+        root, storage_options=storage_options, record_size=record_size,
+        engine=parquet_engine(engine))
+
+    # .zarray entries first, chunk refs are placed by the grid they give
+    keys = sorted(refs.meta_keys(), key=lambda k: not is_meta(k))
+    for key in keys:
+        out[key] = refs[key]
+
+    counts = {}
+    for name, var in refs.vars.items():
+        vprint(f'Writing {var.chunks} refs for {name}')
+        for part in var.parts():
+            out.update(part.refs_from_arrays(*part.unpack_arrays()))
+        counts[name] = var.chunks
+    out.flush()
+    vprint(f'Written parquet references to {root}')
+    return counts
+
+def from_parquet(root, outpath=None, store=None, fmt='json', workers=None, shard=None,
+                 engine=None, storage_options=None):
+    """
+    Pack Parquet references under root into a .kst store.
+
+    The store is outpath/<name>.kst unless store is given. fmt, workers and
+    shard are as for Converter.process. Returns the Converter.
+    """
+    if outpath is None and store is None:
+        raise ValueError('Either outpath or store is needed for the new store')
+    conv = ParquetConverter(root, outpath, store=store, engine=engine, storage_options=storage_options)
+    conv.process(stream=True, fmt=fmt, workers=workers, shard=shard)
+    return conv
@@ -0,0 +1,170 @@
+# Paths.py
+
+# Compact storage for long lists of similar file paths
+#  - Shared directory prefix stripped
+#  - Most common layout kept as a format template with integer fields,
+#    date-like digit runs (YYYYMMDD[hhmm[ss]]) split into their parts
+#  - Each field column stored as a first value and run-length coded steps,
+#    or as a pointer to an identical earlier column
+#  - Paths that do not fit the template are kept whole as exceptions
+
+import os
+import re
+import numpy as np
+
+from collections import Counter
+
+# Digit runs short enough to hold in int64
+DIGITS = re.compile(r'(\d{1,18})')
+
+def common_prefix(paths):
+    # Longest shared prefix, cut back to a directory boundary
+    prefix = os.path.commonprefix(paths)
+    return prefix[:prefix.rfind('/')+1]
+
+def is_date(values):
+    # YYYYMMDD integer column, every entry a plausible date
+    year, month, day = values // 10000, values // 100 % 100, values % 100
+    return bool(np.all((year >= 1800) & (year <= 2200) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)))
+
+def split_date(run):
+    # A digit run of 8, 12 or 14 characters holding dates as year, month, day and time fields
+    lengths = {len(s) for s in run}
+    width = lengths.pop() if len(lengths) == 1 else None
+    if width in (8, 12, 14) and is_date(np.array([int(s[:8]) for s in run], dtype=np.int64)):
+        fields = [[s[:4] for s in run], [s[4:6] for s in run], [s[6:8] for s in run]]
+        if width > 8:
+            fields.append([s[8:] for s in run])
+        return fields
+    return [run]
+
+def field_format(index, field):
+    # Unpadded if no entry has a leading zero, else zero padded to the usual width
+    if not any(len(s) > 1 and s[0] == '0' for s in field):
+        return f'{{{index}}}'
+    width = Counter(len(s) for s in field).most_common(1)[0][0]
+    return f'{{{index}:0{width}d}}'
+
+def encode_column(values):
+    # First value and [step, count] runs of the differences
+    steps = np.diff(values)
+    runs = []
+    if len(steps):
+        breaks = np.flatnonzero(steps[1:] != steps[:-1]) + 1
+        starts = np.concatenate(([0], breaks))
+        counts = np.diff(np.append(starts, len(steps)))
+        runs = [[int(s), int(c)] for s, c in zip(steps[starts], counts)]
+    return {'first': int(values[0]), 'steps': runs}
+
+def decode_column(column, count):
+    values = np.empty(count, dtype=np.int64)
+    if count == 0:
+        return values
+    values[0] = column['first']
+    if column['steps']:
+        steps, counts = zip(*column['steps'])
+        values[1:] = column['first'] + np.cumsum(np.repeat(steps, counts))
+    return values
+
+def escape(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+def compress_paths(paths):
+    """
+    Compress a list of file paths into a json-able spec, see PathTable.
+
+    The most common layout of literal text between digit runs becomes the
+    template, paths with any other layout or that do not format back
+    exactly are stored as exceptions.
+    """
+    paths = list(paths)
+    prefix = common_prefix(paths)
+    suffixes = [p[len(prefix):] for p in paths]
+    parts = [DIGITS.split(s) for s in suffixes]
+    layouts = [tuple(p[0::2]) for p in parts]
+    spec = {'prefix': prefix, 'template': None, 'count': len(paths), 'columns': [], 'exceptions': {}}
+    if not paths:
+        return spec
+
+    layout = Counter(layouts).most_common(1)[0][0]
+    rows = [i for i, l in enumerate(layouts) if l == layout]
+    runs = [list(r) for r in zip(*[parts[i][1::2] for i in rows])]
+
+    template, fields = escape(layout[0]), []
+    for run, literal in zip(runs, layout[1:]):
+        for field in split_date(run):
+            template += field_format(len(fields), field)
+            fields.append(field)
+        template += escape(literal)
+    spec['template'] = template
+
+    # Field values for every path, exception rows repeat the previous row
+    values = np.zeros((len(fields), len(paths)), dtype=np.int64)
+    if fields:
+        values[:, rows] = np.array([[int(s) for s in field] for field in fields], dtype=np.int64)
+    matched = np.zeros(len(paths), dtype=bool)
+    matched[rows] = True
+    fill = np.maximum.accumulate(np.where(matched, np.arange(len(paths)), 0))
+    values = values[:, fill]
+
+    for i, suffix in enumerate(suffixes):
+        if not matched[i] or template.format(*values[:, i].tolist()) != suffix:
+            spec['exceptions'][str(i)] = suffix
+
+    for j, column in enumerate(values):
+        same = [k for k in range(j) if np.array_equal(values[k], column)]
+        spec['columns'].append({'same': same[0]} if same else encode_column(column))
+    return spec
+
+class PathTable:
+    """
+    Read-only list of file paths decoded from a compress_paths spec.
+
+    Field columns are decoded up front, each path string is only built
+    when it is first asked for.
+    """
+    def __init__(self, spec):
+        self.prefix = spec['prefix']
+        self.template = spec['template']
+        self.count = spec['count']
+        self.exceptions = {int(k): v for k, v in spec['exceptions'].items()}
+        columns = []
+        for column in spec['columns']:
+            if 'same' in column:
+                columns.append(columns[column['same']])
+            else:
+                columns.append(decode_column(column, self.count))
+        self.columns = np.array(columns, dtype=np.int64).reshape(len(columns), self.count)
+        self.built = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        index = int(index)
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError(f'File index {index} out of range')
+        path = self.built.get(index)
+        if path is None:
+            suffix = self.exceptions.get(index)
+            if suffix is None:
+                suffix = self.template.format(*self.columns[:, index].tolist())
+            path = self.built[index] = self.prefix + suffix
+        return path
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def tolist(self):
+        return list(self)
+
+def expand_paths(files):
+    # meta.json files entry as a sequence of paths, either form
+    if isinstance(files, dict):
+        return PathTable(files)
+    return files
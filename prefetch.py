@@ -0,0 +1,156 @@
+# Prefetch.py
+
+# Read-ahead along the leading chunk dimension of a store mapper
+#  - Each read of a variable is reduced to its leading chunk indices and
+#    the pattern of the remaining indices
+#  - Two reads in a row with the same pattern, the second starting where
+#    the first ended, count as a sequential walk
+#  - The next timesteps of that pattern are then fetched in background
+#    threads, as many as cover the fetch time seen against the time
+#    between reads, within a byte budget
+
+import math
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher:
+    """
+    Background read-ahead for a KStoreFileSystem.
+
+    max_depth caps how many leading steps are read ahead, maxbytes the
+    bytes held or in flight, workers the steps fetched at once. Chunks
+    read ahead are handed over once through take.
+    """
+    def __init__(self, fs, max_depth=16, maxbytes=2**27, workers=2):
+        self.fs = fs
+        self.max_depth = max_depth
+        self.maxbytes = maxbytes
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.buffer = OrderedDict()
+        self.nbytes = 0
+        self.inflight = 0
+        self.pending = {}
+        self.walks = {}
+        self.fetch_time = None
+        self.interval = None
+        self.last = None
+        self.hits = 0
+        self.issued = 0
+        self.dropped = 0
+
+    def depth(self):
+        # Steps needed to hide the fetch time behind the work between reads
+        if not self.fetch_time or not self.interval:
+            return 2
+        return max(1, min(self.max_depth, math.ceil(self.fetch_time / self.interval) + 1))
+
+    def take(self, key):
+        # Prefetched bytes for key, waiting if it is in flight, else None
+        with self.lock:
+            future = self.pending.get(key)
+        if future is not None:
+            future.result()
+        with self.lock:
+            data = self.buffer.pop(key, None)
+            if data is None:
+                return None
+            self.nbytes -= len(data)
+            self.hits += 1
+        return data
+
+    def observe(self, keys, elapsed):
+        # Record a read of chunk keys and read ahead if it continues a walk
+        now = time.perf_counter()
+        reads = {}
+        for key in keys:
+            var, _, chunk = key.partition('/')
+            lead, _, rest = chunk.partition('.')
+            leads, pattern = reads.setdefault(var, (set(), set()))
+            leads.add(int(lead))
+            pattern.add(rest)
+
+        scheduled = []
+        with self.lock:
+            if self.last is not None:
+                gap = now - elapsed - self.last
+                self.interval = gap if self.interval is None else 0.7 * self.interval + 0.3 * gap
+            self.last = now
+            depth = self.depth()
+            for var, (leads, pattern) in reads.items():
+                lo, hi = min(leads), max(leads)
+                walk = self.walks.get(var)
+                if walk and walk['pattern'] == pattern and lo == walk['hi'] + 1:
+                    walk['hi'] = hi
+                    span = hi - lo + 1
+                    first = max(hi, walk['ahead']) + 1
+                    last = min(hi + depth * span, self.fs.references.vars[var].grid[0] - 1)
+                    scheduled.append((var, pattern, first, last))
+                else:
+                    self.walks[var] = {'pattern': pattern, 'hi': hi, 'ahead': hi}
+
+        for var, pattern, first, last in scheduled:
+            self.schedule(var, pattern, first, last)
+
+    def schedule(self, var, pattern, first, last):
+        for lead in range(first, last + 1):
+            keys = [f'{var}/{lead}.{rest}' if rest else f'{var}/{lead}' for rest in sorted(pattern)]
+            refs = self.fs.references.lookup_many(keys)
+            with self.lock:
+                refs = {k: r for k, r in refs.items() if k not in self.pending and k not in self.buffer}
+                size = sum(ref[2] for ref in refs.values())
+                if self.nbytes + self.inflight + size > self.maxbytes:
+                    return
+                self.walks[var]['ahead'] = lead
+                if not refs:
+                    continue
+                self.inflight += size
+                future = self.pool.submit(self.fetch, refs, size)
+                for key in refs:
+                    self.pending[key] = future
+                self.issued += 1
+
+    def fetch(self, refs, size):
+        began = time.perf_counter()
+        ranges = {}
+        for key, (url, start, nbytes) in refs.items():
+            ranges.setdefault(url, []).append((start, start + nbytes, key))
+        try:
+            data = self.fs.fetch_ranges(ranges)
+        except Exception:
+            # Left for the foreground read to fetch and report
+            data = {}
+        elapsed = time.perf_counter() - began
+        with self.lock:
+            self.inflight -= size
+            self.fetch_time = elapsed if self.fetch_time is None else 0.7 * self.fetch_time + 0.3 * elapsed
+            for key in refs:
+                self.pending.pop(key, None)
+                chunk = data.get(key)
+                if chunk is None or isinstance(chunk, Exception):
+                    continue
+                self.buffer[key] = chunk
+                self.nbytes += len(chunk)
+            while self.nbytes > self.maxbytes:
+                _, old = self.buffer.popitem(last=False)
+                self.nbytes -= len(old)
+                self.dropped += 1
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            self.buffer.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'buffered': len(self.buffer),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'issued': self.issued,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,302 @@
+'''
+Read-path benchmark against a local HTTP stand-in for the DAP server.
+
+Writes synthetic NetCDF4/HDF5 files with uncompressed chunked data, builds
+kerchunk refs for them directly from the HDF5 chunk index and converts
+those to a .kst store. The files are then served over HTTP from this
+process, with a configurable per-request latency and bandwidth, and the
+same xarray slice-and-mean as kstore_performance.py is timed through:
+ - json : fsspec reference mapper over the kerchunk json
+ - kst  : unpack.get_mapper over the store (lazy refs, concurrent fetcher)
+ - load : fsspec reference mapper over Converter.load refs
+
+For each mapper the time to first byte (open + first chunk), slice
+throughput and the number of HTTP requests/bytes served are recorded.
+
+Example:
+    python read_benchmark.py --files 4 --times 24 --latency 20 --bandwidth 50
+'''
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+## Server ##
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def add(self, nbytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes += nbytes
+
+    def get(self):
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes}
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # Static file handler with byte range support, latency and bandwidth limits
+    protocol_version = 'HTTP/1.1'
+    root = '.'
+    latency = 0.0
+    bandwidth = None
+    counter = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_range(self, size):
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes='):
+            return 0, size
+        start, _, end = header[6:].partition('-')
+        if start == '':
+            return max(0, size - int(end)), size
+        end = int(end) + 1 if end else size
+        return int(start), min(end, size)
+
+    def respond(self, body=True):
+        path = os.path.join(self.root, self.path.lstrip('/').split('?')[0])
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        start, end = self.get_range(size)
+        partial = 'Range' in self.headers
+
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{end-1}/{size}')
+        self.end_headers()
+        if not body:
+            self.counter.add(0)
+            return
+
+        f = open(path, 'rb')
+        f.seek(start)
+        data = f.read(end - start)
+        f.close()
+        self.counter.add(len(data))
+        if not self.bandwidth:
+            self.wfile.write(data)
+            return
+        block = 2**16
+        for pos in range(0, len(data), block):
+            self.wfile.write(data[pos:pos+block])
+            time.sleep(min(block, len(data) - pos) / self.bandwidth)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+def serve(root, latency=0.0, bandwidth=None):
+    # Start a threaded server on a free local port
+    handler = type('Handler', (RangeHandler,), {
+        'root': root,
+        'latency': latency,
+        'bandwidth': bandwidth,
+        'counter': Counter(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, handler.counter
+
+## Data ##
+
+def write_files(datadir, nfiles, ntimes, shape, chunks):
+    # Files split the time axis, each holds ntimes steps of 'tas'
+    from netCDF4 import Dataset
+    os.makedirs(datadir, exist_ok=True)
+    ny, nx = shape
+    rng = np.random.default_rng(0)
+    names = []
+    for i in range(nfiles):
+        name = f'synthetic_{i:04d}.nc'
+        ds = Dataset(os.path.join(datadir, name), 'w')
+        ds.createDimension('time', ntimes)
+        ds.createDimension('lat', ny)
+        ds.createDimension('lon', nx)
+        tas = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'),
+                                chunksizes=(1, *chunks), fill_value=False)
+        tas[:] = rng.random((ntimes, ny, nx), dtype=np.float32)
+        ds.close()
+        names.append(name)
+    return names
+
+def b64(values):
+    return 'base64:' + base64.b64encode(values.tobytes()).decode()
+
+def zarray(shape, chunks, dtype):
+    return json.dumps({
+        'chunks': chunks, 'compressor': None, 'dtype': dtype, 'fill_value': None,
+        'filters': None, 'order': 'C', 'shape': shape, 'zarr_format': 2,
+    })
+
+def make_refs(datadir, names, url):
+    # Kerchunk refs built from the HDF5 chunk index, one time chunk per step
+    import h5py
+    refs = {
+        '.zgroup': json.dumps({'zarr_format': 2}),
+        '.zattrs': json.dumps({'title': 'read benchmark'}),
+    }
+    offset = 0
+    for name in names:
+        f = h5py.File(os.path.join(datadir, name), 'r')
+        dset = f['tas']
+        ntimes, ny, nx = dset.shape
+        cy, cx = dset.chunks[1:]
+        for i in range(dset.id.get_num_chunks()):
+            info = dset.id.get_chunk_info(i)
+            t, y, x = info.chunk_offset
+            refs[f'tas/{t + offset}.{y // cy}.{x // cx}'] = [f'{url}/{name}', info.byte_offset, info.size]
+        f.close()
+        offset += ntimes
+
+    refs['tas/.zarray'] = zarray([offset, ny, nx], [1, cy, cx], '<f4')
+    refs['tas/.zattrs'] = json.dumps({'_ARRAY_DIMENSIONS': ['time', 'lat', 'lon']})
+    coords = {
+        'time': np.arange(offset, dtype='<i8'),
+        'lat': np.linspace(-90, 90, ny, dtype='<f4'),
+        'lon': np.linspace(-180, 180, nx, dtype='<f4'),
+    }
+    for dim, values in coords.items():
+        refs[f'{dim}/.zarray'] = zarray([len(values)], [len(values)], values.dtype.str)
+        refs[f'{dim}/.zattrs'] = json.dumps({'_ARRAY_DIMENSIONS': [dim]})
+        refs[f'{dim}/0'] = b64(values)
+    return {'version': 1, 'refs': refs}
+
+## Mappers ##
+
+def get_mapper(kind, kfile, store):
+    import fsspec
+    if kind == 'json':
+        return fsspec.get_mapper('reference://', fo=kfile, remote_protocol='http')
+    if kind == 'kst':
+        import unpack
+        return unpack.get_mapper('reference://', fo=store, remote_protocol='http', fetcher=True)
+    if kind == 'load':
+        import convert
+        refs = convert.Converter(None, None, store=store).load()
+        return fsspec.get_mapper('reference://', fo=refs, remote_protocol='http')
+    raise ValueError(f'Unknown mapper {kind}')
+
+def read_case(kind, kfile, store, counter, tslice):
+    import xarray as xr
+    counter.reset()
+    t0 = time.perf_counter()
+    mapper = get_mapper(kind, kfile, store)
+    ds = xr.open_zarr(mapper, consolidated=False)
+    opened = time.perf_counter() - t0
+    ds['tas'][0, 0, 0].values
+    first = time.perf_counter() - t0
+    setup = counter.get()
+
+    counter.reset()
+    t1 = time.perf_counter()
+    data = ds['tas'][tslice].values
+    mean = float(data.mean())
+    elapsed = time.perf_counter() - t1
+    read = counter.get()
+    return {
+        'open_s': round(opened, 4),
+        'ttfb_s': round(first, 4),
+        'setup': setup,
+        'slice_s': round(elapsed, 4),
+        'slice_mb': round(data.nbytes / 2**20, 2),
+        'throughput_mb_s': round(data.nbytes / 2**20 / elapsed, 2),
+        'slice': read,
+        'mean': mean,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Local HTTP read benchmark for kerchunk json and .kst stores')
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--times', type=int, default=24, help='time steps per file')
+    parser.add_argument('--shape', type=int, nargs=2, default=[256, 512])
+    parser.add_argument('--chunks', type=int, nargs=2, default=[128, 128])
+    parser.add_argument('--latency', type=float, default=10.0, help='per request latency in ms')
+    parser.add_argument('--bandwidth', type=float, default=None, help='per response bandwidth in MB/s')
+    parser.add_argument('--slice', type=int, default=None, help='time steps read, default all')
+    parser.add_argument('--mappers', nargs='+', default=['json', 'kst', 'load'], choices=['json', 'kst', 'load'])
+    parser.add_argument('--fmt', default='kpk', choices=['json', 'kpk'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default='kreadbench')
+    parser.add_argument('--keep', action='store_true', help='keep generated files')
+    parser.add_argument('-o', '--output', default='read_benchmark.json')
+    args = parser.parse_args()
+
+    import convert
+    convert.VERBOSE = False
+
+    datadir = os.path.join(args.workdir, 'data')
+    names = write_files(datadir, args.files, args.times, args.shape, args.chunks)
+    bandwidth = args.bandwidth * 2**20 if args.bandwidth else None
+    server, counter = serve(datadir, latency=args.latency / 1000, bandwidth=bandwidth)
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    kfile = os.path.join(args.workdir, 'synthetic.json')
+    f = open(kfile, 'w')
+    f.write(json.dumps(make_refs(datadir, names, url)))
+    f.close()
+    conv = convert.Converter(kfile, args.workdir)
+    conv.process(fmt=args.fmt)
+
+    tslice = slice(0, args.slice or args.files * args.times)
+    report = {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+        'kfile_bytes': os.path.getsize(kfile),
+        'results': {},
+    }
+    for kind in args.mappers:
+        runs = [read_case(kind, kfile, conv.store, counter, tslice) for r in range(args.repeat)]
+        report['results'][kind] = runs
+        best = min(runs, key=lambda r: r['slice_s'])
+        print(f"[INFO] {kind}: ttfb {best['ttfb_s']}s, slice {best['throughput_mb_s']} MB/s, "
+              f"{best['slice']['requests']} requests")
+
+    means = {kind: runs[0]['mean'] for kind, runs in report['results'].items()}
+    if len(set(means.values())) > 1:
+        print(f'[WARN] Mappers disagree on slice mean: {means}')
+
+    server.shutdown()
+    if not args.keep:
+        shutil.rmtree(args.workdir)
+
+    f = open(args.output, 'w')
+    f.write(json.dumps(report, indent=2))
+    f.close()
+    print(f'[INFO] Written {args.output}')
+
+if __name__ == '__main__':
+    main()
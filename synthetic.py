@@ -0,0 +1,128 @@
+'''
+Synthetic kerchunk references for offline testing and benchmarks.
+
+Writes a kerchunk json file with a controlled number of chunks, variables
+and files, without needing any of the source data. Chunk sizes, gaps
+between chunks and inline (base64) coordinate refs can all be varied.
+'''
+
+import base64
+import json
+import numpy as np
+
+# Uncompressed float32 chunks of 1 x 32 x 32
+CHUNK_SHAPE = [1, 32, 32]
+CHUNK_BYTES = 4 * 32 * 32
+
+# Space left at the start of each file, as for a NetCDF/HDF5 header
+HEADER_BYTES = 4096
+
+# Refs formatted per write
+WRITE_BLOCK = 2**16
+
+def get_grid(nchunks, nvars, spatial=(10, 10)):
+    # Chunk grid (time, lat, lon) giving roughly nchunks over all variables
+    per_var = max(1, nchunks // nvars)
+    ny, nx = spatial
+    if per_var < ny * nx:
+        ny = max(1, int(per_var ** 0.5))
+        nx = max(1, per_var // ny)
+    return [max(1, per_var // (ny * nx)), ny, nx]
+
+def zarray(shape, chunks, dtype='<f4'):
+    return json.dumps({
+        'chunks': chunks,
+        'compressor': None,
+        'dtype': dtype,
+        'fill_value': None,
+        'filters': None,
+        'order': 'C',
+        'shape': shape,
+        'zarr_format': 2,
+    })
+
+def coord_refs(name, values, inline, fileref=None):
+    refs = {
+        f'{name}/.zarray': zarray([len(values)], [len(values)], values.dtype.str),
+        f'{name}/.zattrs': json.dumps({'_ARRAY_DIMENSIONS': [name]}),
+    }
+    if inline:
+        refs[f'{name}/0'] = 'base64:' + base64.b64encode(values.tobytes()).decode()
+    else:
+        refs[f'{name}/0'] = [fileref, 0, int(values.nbytes)]
+    return refs
+
+def write_kerchunk(path, nchunks=10**4, nvars=1, nfiles=10, irregular=0.0, gaps=0.0,
+                   inline=True, prefix='/data/synthetic', seed=0):
+    """
+    Write a synthetic kerchunk json file and return a summary of its layout.
+
+    irregular is the fraction of chunks with a size other than the standard
+    chunk size, gaps the fraction preceded by unused bytes. Files split the
+    time dimension evenly and hold each variable's chunks in turn. Refs are
+    written as they are generated so very large files stay within memory.
+    """
+    rng = np.random.default_rng(seed)
+    grid = get_grid(nchunks, nvars)
+    nt, ny, nx = grid
+    variables = [f'var{v}' for v in range(nvars)]
+    nfiles = max(1, min(nfiles, nt))
+    tsplit = np.array_split(np.arange(nt), nfiles)
+    files = [f'{prefix}/file_{i:05d}.nc' for i in range(nfiles)]
+
+    meta = {
+        '.zgroup': json.dumps({'zarr_format': 2}),
+        '.zattrs': json.dumps({'title': 'synthetic'}),
+    }
+    meta.update(coord_refs('time', np.arange(nt, dtype='<i8'), inline, files[0]))
+    meta.update(coord_refs('lat', np.linspace(-90, 90, ny*CHUNK_SHAPE[1], dtype='<f4'), inline, files[0]))
+    meta.update(coord_refs('lon', np.linspace(-180, 180, nx*CHUNK_SHAPE[2], dtype='<f4'), inline, files[0]))
+    for var in variables:
+        meta[f'{var}/.zarray'] = zarray([nt, ny*CHUNK_SHAPE[1], nx*CHUNK_SHAPE[2]], CHUNK_SHAPE)
+        meta[f'{var}/.zattrs'] = json.dumps({'_ARRAY_DIMENSIONS': ['time', 'lat', 'lon']})
+
+    f = open(path, 'w')
+    f.write('{"version": 1, "refs": {')
+    f.write(', '.join(f'{json.dumps(k)}: {json.dumps(v)}' for k, v in meta.items()))
+
+    # Each dimension's labels are formatted once
+    ylabels = [f'.{y}.' for y in range(ny)]
+    xlabels = [str(x) for x in range(nx)]
+    spatial = [y + x for y in ylabels for x in xlabels]
+
+    written = 0
+    for var in variables:
+        for findex, times in enumerate(tsplit):
+            n = len(times) * ny * nx
+            sizes = np.full(n, CHUNK_BYTES, dtype=np.int64)
+            odd = rng.random(n) < irregular
+            sizes[odd] = rng.integers(CHUNK_BYTES // 4, CHUNK_BYTES, odd.sum())
+            spacing = np.where(rng.random(n) < gaps, rng.integers(1, 512, n), 0)
+            offsets = HEADER_BYTES + np.cumsum(spacing) + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            # Later variables follow on within the same file
+            offsets += variables.index(var) * len(times) * ny * nx * CHUNK_BYTES * 2
+
+            # Written a block of timesteps at a time
+            fref = json.dumps(files[findex])
+            step = max(1, WRITE_BLOCK // (ny * nx))
+            for start in range(0, len(times), step):
+                block = times[start:start+step].tolist()
+                first, last = start * ny * nx, (start + len(block)) * ny * nx
+                keys = (f'"{var}/{t}{s}"' for t in block for s in spatial)
+                f.write(''.join(
+                    f', {k}: [{fref}, {o}, {l}]'
+                    for k, o, l in zip(keys, offsets[first:last].tolist(), sizes[first:last].tolist())
+                ))
+            written += n
+    f.write('}}')
+    f.close()
+
+    return {
+        'chunks': written,
+        'variables': nvars,
+        'files': nfiles,
+        'grid': grid,
+        'irregular': irregular,
+        'gaps': gaps,
+        'inline': inline,
+    }
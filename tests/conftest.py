@@ -0,0 +1,23 @@
+# Shared fixtures for the offline tests
+#  - Kerchunk files are made with synthetic.py, refs point at files that
+#    do not exist so only the refs themselves are checked
+
+import pytest
+
+import convert
+import synthetic
+
+from helpers import read_refs
+
+convert.VERBOSE = False
+
+@pytest.fixture
+def kfile(tmp_path):
+    # 2 variables of 10 x 10 x 10 chunks over 5 files
+    path = tmp_path / 'synthetic.json'
+    synthetic.write_kerchunk(str(path), nchunks=2000, nvars=2, nfiles=5, irregular=0.05, gaps=0.02)
+    return str(path)
+
+@pytest.fixture
+def refs(kfile):
+    return read_refs(kfile)
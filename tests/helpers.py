@@ -0,0 +1,66 @@
+# Helpers for the offline tests
+
+import base64
+import json
+
+import numpy as np
+
+def read_refs(path):
+    f = open(path, 'r')
+    refs = json.load(f)
+    f.close()
+    return refs
+
+def write_refs(path, refs):
+    f = open(path, 'w')
+    f.write(json.dumps(refs))
+    f.close()
+    return str(path)
+
+def normalise(refs):
+    # Metadata held as dicts or json strings compares by value
+    out = {}
+    for key, ref in refs.items():
+        if isinstance(ref, str) and key.split('/')[-1].startswith('.'):
+            ref = json.loads(ref)
+        out[key] = ref
+    return out
+
+def time_part(refs, lo, hi):
+    """
+    Refs for timesteps [lo, hi) of a synthetic kerchunk file, renumbered
+    from zero as a separate file set would be for an append.
+    """
+    out = {'version': 1, 'refs': {}}
+    for key, ref in refs['refs'].items():
+        var, _, chunk = key.partition('/')
+        if var.startswith('var') and chunk and chunk[0] != '.':
+            t, rest = chunk.split('.', 1)
+            if lo <= int(t) < hi:
+                out['refs'][f'{var}/{int(t)-lo}.{rest}'] = ref
+        elif var.startswith('var') and chunk == '.zarray':
+            zarray = json.loads(ref)
+            zarray['shape'][0] = hi - lo
+            out['refs'][key] = json.dumps(zarray)
+        elif key == 'time/.zarray':
+            zarray = json.loads(ref)
+            zarray['shape'] = zarray['chunks'] = [hi - lo]
+            out['refs'][key] = json.dumps(zarray)
+        elif key == 'time/0':
+            data = np.frombuffer(base64.b64decode(ref[7:]), dtype='<i8')[lo:hi]
+            out['refs'][key] = 'base64:' + base64.b64encode(data.tobytes()).decode()
+        else:
+            out['refs'][key] = ref
+    return out
+
+def write_data(refs):
+    # Random bytes in every file the chunk refs point at, long enough for each ref
+    ends = {}
+    for ref in refs['refs'].values():
+        if isinstance(ref, list) and len(ref) == 3:
+            ends[ref[0]] = max(ends.get(ref[0], 0), ref[1] + ref[2])
+    rng = np.random.default_rng(0)
+    for path, end in ends.items():
+        f = open(path, 'wb')
+        f.write(rng.integers(0, 256, end, dtype=np.uint8).tobytes())
+        f.close()
@@ -0,0 +1,99 @@
+# Memory and disk tiers of the table and chunk caches
+
+import os
+
+from cache import ChunkCache, TableCache
+from convert import Converter
+from helpers import normalise
+
+def test_chunk_cache_tiers(tmp_path):
+    cache = ChunkCache(maxbytes=250, directory=str(tmp_path), disk_maxbytes=10**6)
+    for k in range(5):
+        cache.put('/data/a.nc', k * 100, 100, memoryview(bytes([k]) * 100))
+    # The memory tier keeps the two most recent, every chunk is on disk
+    assert cache.stats()['entries'] == 2
+    assert cache.get('/data/a.nc', 400, 100) == bytes([4]) * 100
+    assert cache.get('/data/a.nc', 0, 100) == bytes([0]) * 100
+    assert cache.get('/data/a.nc', 0, 99) is None
+    assert {k: cache.stats()[k] for k in ('hits', 'disk_hits', 'misses')} == \
+        {'hits': 1, 'disk_hits': 1, 'misses': 1}
+
+    # Other processes see the disk tier, partial entries are misses
+    other = ChunkCache(maxbytes=250, directory=str(tmp_path))
+    assert other.get('/data/a.nc', 200, 100) == bytes([2]) * 100
+    path = other.path(('/data/a.nc', 300, 100))
+    f = open(path, 'wb')
+    f.write(b'x' * 10)
+    f.close()
+    assert other.get('/data/a.nc', 300, 100) is None
+    other.clear(disk=True)
+    assert other.stats()['entries'] == 0 and not os.path.isfile(path)
+
+def test_chunk_cache_eviction(tmp_path):
+    cache = ChunkCache(maxbytes=0, directory=str(tmp_path), disk_maxbytes=1600)
+    for k in range(40):
+        cache.put('/data/a.nc', k * 100, 100, bytes(100))
+        os.utime(cache.path(('/data/a.nc', k * 100, 100)), (k, k))
+    cache.evict_disk()
+    kept = [k for k in range(40) if os.path.isfile(cache.path(('/data/a.nc', k * 100, 100)))]
+    # Oldest used go first
+    assert kept == list(range(24, 40))
+
+def table_store(kfile, tmp_path, **kwargs):
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(**kwargs)
+    conv = Converter(None, None, store=conv.store)
+    conv.read_meta()
+    return conv
+
+def npz_files(directory):
+    return [n for n in os.listdir(directory) if n.endswith('.npz')]
+
+def test_table_cache_loads(kfile, refs, tmp_path):
+    store = table_store(kfile, tmp_path, fmt='kpk', shard=4).store
+    cache = TableCache(directory=str(tmp_path / 'tables'))
+    for _ in range(2):
+        loaded = Converter(None, None, store=store).load(cache=cache)
+        assert normalise(loaded['refs']) == normalise(refs['refs'])
+    # Two variables of three shards, unpacked once each
+    assert cache.stats()['misses'] == 6 and cache.stats()['hits'] == 6
+
+    # A time range is cut from the cached table of each shard it covers
+    loaded = Converter(None, None, store=store).load(cache=cache, time=slice(5, 7))['refs']
+    assert {k for k in loaded if k.startswith('var0/') and k[5] != '.'} == \
+        {k for k in refs['refs'] if k.startswith('var0/') and k[5] in '56' and k[6] == '.'}
+
+def test_table_cache_tiers(kfile, tmp_path):
+    conv = table_store(kfile, tmp_path, fmt='kpk')
+    var = conv.vars['var0']
+    directory = str(tmp_path / 'tables')
+    cache = TableCache(directory=directory)
+    keys, table = cache.fetch(var)
+    assert cache.get(var) is not None and not table.flags.writeable
+
+    # Another process finds the table on disk, content hashes are keys of their own
+    other = TableCache(directory=directory)
+    assert other.get(var)[0].tolist() == keys.tolist() and other.stats()['disk_hits'] == 1
+    assert TableCache(directory=directory, hashing=True).get(var) is None
+
+    # A rewritten pack is a new entry
+    os.utime(f'{conv.store}/var0.kpk', ns=(1, 1))
+    assert cache.get(var) is None
+
+    # The memory tier is a capped LRU
+    small = TableCache(maxbytes=keys.nbytes + table.nbytes)
+    small.put(var, (keys.copy(), table.copy()))
+    small.put(conv.vars['var1'], cache.fetch(conv.vars['var1']))
+    assert small.stats()['entries'] == 1 and small.get(var) is None
+
+def test_table_cache_eviction(kfile, tmp_path):
+    parts = table_store(kfile, tmp_path, fmt='kpk', shard=2).vars['var0'].parts()
+    directory = str(tmp_path / 'tables')
+    size = sum(a.nbytes for a in parts[0].unpack_arrays())
+    cache = TableCache(directory=directory, disk_maxbytes=3 * size + 2000)
+    for part in parts:
+        cache.fetch(part)
+    # Five shards of equal size, the disk tier holds the last three
+    assert sorted(npz_files(directory)) == sorted(os.path.basename(cache.path(cache.key(p))) for p in parts[2:])
+    cache.clear(disk=True)
+    assert not npz_files(directory) and cache.stats()['entries'] == 0
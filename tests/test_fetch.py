@@ -0,0 +1,105 @@
+# Concurrent range fetching against a local http server
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from fetch import FetchError, Fetcher
+
+web = pytest.importorskip('aiohttp.web')
+
+DATA = bytes(range(256)) * 16
+
+class Server:
+    """
+    aiohttp server on a background loop. /flaky/<n> fails with 503 n times
+    before answering, /full ignores the range, /slow records how many
+    requests are open at once.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.open = 0
+        self.most = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_get('/{name}/{arg}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def handle(self, request):
+        name, arg = request.match_info['name'], request.match_info['arg']
+        key = f'{name}/{arg}'
+        self.calls[key] = self.calls.get(key, 0) + 1
+        start, end = (int(b) for b in request.headers['Range'][6:].split('-'))
+        if name == 'missing':
+            return web.Response(status=404)
+        if name == 'forbidden':
+            return web.Response(status=403)
+        if name == 'flaky' and self.calls[key] <= int(arg):
+            return web.Response(status=503)
+        if name == 'full':
+            return web.Response(body=DATA)
+        if name == 'slow':
+            self.open += 1
+            self.most = max(self.most, self.open)
+            await asyncio.sleep(0.02)
+            self.open -= 1
+        return web.Response(status=206, body=DATA[start:end+1])
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.port}/{path}'
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher(per_host=2, retries=3, backoff=0.02)
+    yield fetcher
+    fetcher.close()
+
+def test_ranges(server, fetcher):
+    urls = [server.url('data/0'), server.url('full/0'), server.url('data/1')]
+    out = fetcher.fetch(urls, [0, 100, 4000], [10, 300, 4096])
+    assert out == [DATA[0:10], DATA[100:300], DATA[4000:4096]]
+    assert fetcher.stats() == {'requests': 3, 'retried': 0, 'bytes': 306}
+    assert fetcher.fetch([], [], []) == []
+
+def test_retry_backoff(server, fetcher):
+    t0 = time.perf_counter()
+    out = fetcher.fetch([server.url('flaky/2')], [0], [16])
+    # Waits of backoff then twice backoff before the third attempt
+    assert out == [DATA[:16]] and time.perf_counter() - t0 >= 0.06
+    assert server.calls['flaky/2'] == 3 and fetcher.stats()['retried'] == 2
+
+def test_errors(server, fetcher):
+    out = fetcher.fetch([server.url('flaky/9'), server.url('missing/0'), server.url('forbidden/0'), server.url('data/0')],
+                        [0, 0, 0, 0], [8, 8, 8, 8])
+    # Retries run out, missing files and other statuses are not retried
+    assert isinstance(out[0], FetchError) and server.calls['flaky/9'] == 4
+    assert isinstance(out[1], FileNotFoundError) and server.calls['missing/0'] == 1
+    assert isinstance(out[2], FetchError) and server.calls['forbidden/0'] == 1
+    assert out[3] == DATA[:8]
+
+def test_per_host_limit(server, fetcher):
+    n = 12
+    out = fetcher.fetch([server.url(f'slow/{i}') for i in range(n)], [0] * n, [4] * n)
+    assert out == [DATA[:4]] * n and server.most == 2
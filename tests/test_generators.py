@@ -0,0 +1,88 @@
+# Generator packing of kerchunk refs in kpg_convert
+
+import copy
+
+import kpg_convert
+
+from paths import expand_paths
+
+# Two variables on a 2 x 2 grid over two files, b/1.0 is missing
+SMALL = {
+    'a/.zarray': '{"shape": [2, 2], "chunks": [1, 1]}',
+    'b/.zarray': '{"shape": [2, 2], "chunks": [1, 1]}',
+    'a/0.0': ['/d/f0.nc', 0, 10], 'b/0.0': ['/d/f0.nc', 10, 20],
+    'a/0.1': ['/d/f0.nc', 30, 10], 'b/0.1': ['/d/f0.nc', 40, 20],
+    'a/1.0': ['/d/f1.nc', 0, 12],
+    'a/1.1': ['/d/f1.nc', 50, 10], 'b/1.1': ['/d/f1.nc', 60, 20],
+}
+
+def chunk_refs(refs):
+    return {k: v for k, v in refs.items() if isinstance(v, list) and len(v) == 3}
+
+def test_install_generators():
+    # As the per-chunk loop packed it, with files as compressed paths
+    out = kpg_convert.install_generators({'refs': copy.deepcopy(SMALL)}, ['a', 'b'], [2, 2])
+    gen = out['gen']
+    assert [list(f) for f in zip(gen['files']['ends'], expand_paths(gen['files']['paths']))] == \
+        [[3, '/d/f0.nc'], [8, '/d/f1.nc']]
+    assert {k: v for k, v in gen.items() if k != 'files'} == {
+        'variables': ['a', 'b'],
+        'varwise': True,
+        'skipchunks': {'1.0': [0, 1]},
+        'dims': [2, 2],
+        'unique': {'ids': [4], 'lengths': [12]},
+        'gaps': {'ids': [4, 6], 'lengths': [-60, 38]},
+        'start': '0',
+        'lengths': [10, 20],
+        'dimensions': {'i': {'stop': '8'}},
+        'gfactor': '0.5',
+    }
+    # Packed chunk refs leave the refs dict
+    assert set(out['refs']) == {'a/.zarray', 'b/.zarray'}
+
+def test_install_generators_synthetic(refs):
+    out = kpg_convert.install_generators(copy.deepcopy(refs), ['var0', 'var1'], [10, 10, 10])
+    assert not chunk_refs(out['refs'])
+    gen = out['gen']
+    assert gen['dimensions']['i']['stop'] == '2000' and not gen['skipchunks']
+    assert list(expand_paths(gen['files']['paths'])) == [f'/data/synthetic/file_{i:05d}.nc' for i in range(5)]
+
+def zarray(shape, chunks):
+    return '{"shape": %s, "chunks": %s}' % (list(shape), list(chunks))
+
+def test_access_kerchunk(refs):
+    assert kpg_convert.access_kerchunk(refs) == (['var0', 'var1'], [10, 10, 10])
+    assert kpg_convert.access_kerchunk(refs, time_dim=4) == (['var0', 'var1'], [4, 10, 10])
+
+    # Variables with the most dimensions chunked over 1 win, edge chunks count
+    out = {'refs': {
+        'time/.zarray': zarray([25], [1]),
+        'sst/.zarray': zarray([25, 100, 180], [1, 50, 60]),
+        'mask/.zarray': zarray([25, 100, 180], [1, 1, 180]),
+        'ice/.zarray': zarray([25, 95, 180], [1, 50, 60]),
+    }}
+    assert kpg_convert.access_kerchunk(out) == (['sst', 'ice'], [25, 2, 3])
+
+    # Without internal chunking every variable is one chunk
+    out = {'refs': {'sst/.zarray': zarray([10, 20], [10, 20]), 'ice/.zarray': zarray([10, 20], [10, 20])}}
+    assert kpg_convert.access_kerchunk(out) == (['sst', 'ice'], [1, 1])
+
+def test_generator_index():
+    out = kpg_convert.install_generators({'refs': copy.deepcopy(SMALL)}, ['a', 'b'], [2, 2])
+    index = kpg_convert.GeneratorIndex(out['gen'])
+    assert index.lookup('a', '1.0') == ['/d/f1.nc', 0, 12]
+    assert index.lookup('b', [1, 1]) == ['/d/f1.nc', 60, 20]
+    assert index.lookup('b', '1.0') is None
+    files, offsets, sizes = index.lookup_many('b', [[0, 1], [1, 0], [1, 1]])
+    assert files.tolist() == ['/d/f0.nc', None, '/d/f1.nc']
+    assert offsets[[0, 2]].tolist() == [40, 60] and sizes.tolist() == [20, 0, 20]
+    assert index.unpack() == chunk_refs(SMALL)
+
+    # Generators written before path compression list [end, name] pairs
+    gen = dict(out['gen'], files=[[3, '/d/f0.nc'], [8, '/d/f1.nc']])
+    assert kpg_convert.GeneratorIndex(gen).unpack() == chunk_refs(SMALL)
+
+def test_fast_unpack(refs):
+    out = copy.deepcopy(refs)
+    out = kpg_convert.install_generators(out, *kpg_convert.access_kerchunk(out))
+    assert kpg_convert.fast_unpack(out) == chunk_refs(refs['refs'])
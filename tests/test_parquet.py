@@ -0,0 +1,28 @@
+# Round trips between stores and kerchunk's Parquet references
+
+import importlib.util
+
+import pytest
+
+import verify
+
+from convert import Converter
+from helpers import normalise
+
+if not any(importlib.util.find_spec(name) for name in ('pyarrow', 'fastparquet')):
+    pytest.skip('Parquet references need pyarrow or fastparquet', allow_module_level=True)
+
+from parquet import from_parquet, to_parquet
+
+@pytest.mark.parametrize('kwargs', [{'fmt': 'json'}, {'fmt': 'kpk', 'shard': 3}])
+def test_parquet_round_trip(kfile, refs, tmp_path, kwargs):
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(**kwargs)
+    root = str(tmp_path / 'synthetic.parq')
+    counts = to_parquet(conv.store, root, record_size=37)
+    assert counts == {'var0': 1000, 'var1': 1000}
+
+    back = from_parquet(root, str(tmp_path / 'back'), **kwargs)
+    loaded = Converter(None, None, store=back.store).load()
+    assert normalise(loaded['refs']) == normalise(refs['refs'])
+    assert verify.verify_store(back.store, kfile)['ok']
@@ -0,0 +1,56 @@
+# File list compression
+
+import json
+
+import pytest
+
+from paths import PathTable, compress_paths, expand_paths
+
+def cci_paths(days):
+    return [
+        f'/neodc/esacci/sst/data/{d // 10000}/{d // 100 % 100:02d}/{d}120000-ESACCI-L4_GHRSST-SST-fv3.00.nc'
+        for d in days
+    ]
+
+def round_trip(paths):
+    spec = json.loads(json.dumps(compress_paths(paths)))
+    return spec, PathTable(spec)
+
+def test_date_template():
+    paths = cci_paths([*range(20191201, 20191232), *range(20200101, 20200132)])
+    spec, table = round_trip(paths)
+    assert spec['prefix'] == '/neodc/esacci/sst/data/'
+    # The date run is split into year, month and day fields
+    assert spec['template'].startswith('{0}/{1:02d}/{2}{3:02d}{4:02d}{5}-') and not spec['exceptions']
+    # Repeated year and month columns point at the first copy
+    assert sum('same' in c for c in spec['columns']) == 2
+    assert table.tolist() == paths
+    assert len(json.dumps(spec)) < len(json.dumps(paths)) // 5
+
+def test_exceptions():
+    paths = cci_paths(range(20200101, 20200111))
+    paths[3] = paths[3].replace('fv3.00', 'fv3.01-reprocessed')
+    paths.insert(5, '/neodc/esacci/sst/data/README')
+    spec, table = round_trip(paths)
+    assert sorted(spec['exceptions']) == ['3', '5']
+    assert list(table) == paths
+
+def test_indexes():
+    paths = [f'/data/run{r}/part_{i:03d}.nc' for r in (1, 2) for i in range(0, 50, 5)]
+    spec, table = round_trip(paths)
+    assert table.tolist() == paths and not spec['exceptions']
+
+def test_path_table_access():
+    paths = cci_paths(range(20200101, 20200106))
+    table = PathTable(compress_paths(paths))
+    assert len(table) == 5
+    assert table[-1] == paths[-1] and table[1:3] == paths[1:3]
+    # Strings are only built when asked for
+    assert list(table.built) == [4, 1, 2]
+    with pytest.raises(IndexError):
+        table[5]
+
+def test_expand_paths():
+    assert expand_paths(['/a.nc', '/b.nc']) == ['/a.nc', '/b.nc']
+    assert expand_paths(compress_paths([])).tolist() == []
+    assert expand_paths(compress_paths(['/data/only.nc'])).tolist() == ['/data/only.nc']
@@ -0,0 +1,76 @@
+# Read-ahead along the leading dimension of a store mapper
+
+import pytest
+
+import synthetic
+
+from convert import Converter
+from helpers import read_refs, write_data
+from prefetch import Prefetcher
+from unpack import get_mapper
+
+@pytest.fixture
+def local(tmp_path):
+    # One variable of 12 x 10 x 10 chunks in files that exist
+    data = tmp_path / 'data'
+    data.mkdir()
+    kfile = str(tmp_path / 'local.json')
+    synthetic.write_kerchunk(kfile, nchunks=1200, nvars=1, nfiles=4, prefix=str(data))
+    refs = read_refs(kfile)
+    write_data(refs)
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(fmt='kpk')
+    return conv.store, refs
+
+def read_ref(ref):
+    f = open(ref[0], 'rb')
+    f.seek(ref[1])
+    data = f.read(ref[2])
+    f.close()
+    return data
+
+def step(t):
+    # A row of chunks at timestep t, as a lat slice read would ask for
+    return [f'var0/{t}.3.{x}' for x in range(10)]
+
+def read_steps(fs, refs, steps):
+    for t in steps:
+        out = fs.cat(step(t))
+        assert {k: bytes(v) for k, v in out.items()} == {k: read_ref(refs['refs'][k]) for k in step(t)}
+
+def test_sequential(local):
+    store, refs = local
+    fs = get_mapper('reference://', fo=store, prefetch={'max_depth': 4}).fs
+    read_steps(fs, refs, range(12))
+    # Every step after the two that start the walk was read ahead
+    stats = fs.prefetcher.stats()
+    assert stats['hits'] == 10 * 10 and stats['issued'] == 10
+    fs.prefetcher.close()
+
+def test_random(local):
+    store, refs = local
+    fs = get_mapper('reference://', fo=store, prefetch=True).fs
+    read_steps(fs, refs, [5, 2, 9, 0, 7])
+    assert fs.prefetcher.stats()['issued'] == 0
+    fs.prefetcher.close()
+
+def test_budget(local):
+    # Steps that do not fit the byte budget are not read ahead
+    store, refs = local
+    fs = get_mapper('reference://', fo=store, prefetch={'maxbytes': 1000}).fs
+    read_steps(fs, refs, range(6))
+    assert fs.prefetcher.stats()['issued'] == 0 and fs.prefetcher.stats()['bytes'] == 0
+    fs.prefetcher.close()
+
+def test_depth():
+    prefetcher = Prefetcher(None, max_depth=8)
+    assert prefetcher.depth() == 2
+    # Deep enough to cover the fetch time with the time between reads
+    prefetcher.fetch_time, prefetcher.interval = 0.5, 0.1
+    assert prefetcher.depth() == 6
+    prefetcher.interval = 0.01
+    assert prefetcher.depth() == 8
+    # Fast fetches still keep one step beyond the next in flight
+    prefetcher.fetch_time = 0.001
+    assert prefetcher.depth() == 2
+    prefetcher.close()
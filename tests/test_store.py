@@ -0,0 +1,142 @@
+# Converter round trips, selective loads and appends
+
+import json
+
+import numpy as np
+import pytest
+
+from convert import Converter, ShardedVariable
+from helpers import normalise, read_refs, time_part, write_refs
+
+CASES = [
+    {'fmt': 'json'},
+    {'fmt': 'kpk'},
+    {'fmt': 'json', 'stream': True},
+    {'fmt': 'kpk', 'workers': 2},
+    {'fmt': 'kpk', 'shard': 3},
+    {'fmt': 'json', 'shard': 4, 'stream': True},
+    {'fmt': 'nc'},
+    {'fmt': 'nc', 'shard': 3},
+]
+
+def store_of(kfile, tmp_path, **kwargs):
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(**kwargs)
+    return conv.store
+
+@pytest.mark.parametrize('kwargs', CASES)
+def test_round_trip(kfile, refs, tmp_path, kwargs):
+    store = store_of(kfile, tmp_path, **kwargs)
+    loaded = Converter(None, None, store=store).load()
+    assert normalise(loaded['refs']) == normalise(refs['refs'])
+
+def test_round_trip_referenced_coords(tmp_path):
+    import synthetic
+    kfile = str(tmp_path / 'coords.json')
+    synthetic.write_kerchunk(kfile, nchunks=500, nvars=1, nfiles=3, inline=False)
+    refs = read_refs(kfile)
+    store = store_of(kfile, tmp_path, fmt='kpk')
+    assert Converter(None, None, store=store).load()['refs'] == refs['refs']
+
+@pytest.mark.parametrize('kwargs', [{}, {'fmt': 'kpk', 'shard': 3}])
+def test_verify(kfile, tmp_path, kwargs):
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    assert conv.process(verify=True, **kwargs)['ok']
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    assert conv.process(verify=20, **kwargs)['ok']
+
+def test_load_variables(kfile, refs, tmp_path):
+    store = store_of(kfile, tmp_path, fmt='kpk')
+    loaded = Converter(None, None, store=store).load(variables=['var1'])['refs']
+    assert not [k for k in loaded if k.startswith('var0/') and k[5] != '.']
+    expected = {k: v for k, v in refs['refs'].items() if k.startswith('var1/')}
+    assert {k: v for k, v in loaded.items() if k.startswith('var1/')} == expected
+    assert loaded['time/.zarray'] == refs['refs']['time/.zarray']
+    with pytest.raises(ValueError):
+        Converter(None, None, store=store).load(variables=['missing'])
+
+@pytest.mark.parametrize('kwargs', [{'fmt': 'json'}, {'fmt': 'kpk', 'shard': 3}])
+def test_load_time(kfile, refs, tmp_path, kwargs):
+    store = store_of(kfile, tmp_path, **kwargs)
+    loaded = Converter(None, None, store=store).load(time=slice(4, 7))['refs']
+    chunks = [k for k in loaded if k.startswith('var') and k.split('/')[1][0] != '.']
+    assert chunks and {int(k.split('/')[1].split('.')[0]) for k in chunks} == {4, 5, 6}
+    assert all(loaded[k] == refs['refs'][k] for k in chunks)
+
+@pytest.mark.parametrize('fmt', ['json', 'kpk', 'nc'])
+def test_append(refs, tmp_path, fmt):
+    first = write_refs(tmp_path / 'first.json', time_part(refs, 0, 4))
+    store = store_of(first, tmp_path, fmt=fmt)
+    Converter(None, None, store=store).append(time_part(refs, 4, 7))
+    # Streaming only applies to files, a dict is used as it is
+    Converter(None, None, store=store).append(time_part(refs, 7, 9), stream=True)
+    Converter(None, None, store=store).append(write_refs(tmp_path / 'last.json', time_part(refs, 9, 10)), stream=True)
+    loaded = Converter(None, None, store=store).load()
+    assert normalise(loaded['refs']) == normalise(refs['refs'])
+
+def test_append_sharded(refs, tmp_path):
+    first = write_refs(tmp_path / 'first.json', time_part(refs, 0, 4))
+    store = store_of(first, tmp_path, fmt='kpk', shard=3)
+    Converter(None, None, store=store).append(time_part(refs, 4, 5))
+    Converter(None, None, store=store).append(time_part(refs, 5, 10))
+    loaded = Converter(None, None, store=store).load()
+    assert normalise(loaded['refs']) == normalise(refs['refs'])
+
+    # The last shard is filled before new ones start, each at most 3 steps
+    conv = Converter(None, None, store=store)
+    conv.read_meta()
+    var = conv.vars['var0']
+    assert isinstance(var, ShardedVariable)
+    assert var.ranges == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert [s.chunks for s in var.shards] == [300, 300, 300, 100]
+
+def test_append_unknown_variable(refs, tmp_path):
+    first = write_refs(tmp_path / 'first.json', time_part(refs, 0, 4))
+    store = store_of(first, tmp_path)
+    extra = time_part(refs, 4, 5)
+    extra['refs']['other/0.0.0'] = ['/data/other.nc', 0, 10]
+    with pytest.raises(ValueError):
+        Converter(None, None, store=store).append(extra)
+
+def test_odd_chunk_keys(refs, tmp_path):
+    # Refs under keys that are not chunk indices stay metadata refs
+    odd = dict(refs['refs'])
+    odd['crs/abc'] = ['/data/synthetic/file_00000.nc', 10, 20]
+    odd['crs/.zattrs'] = '{}'
+    odd['var0/-1.0.0'] = ['/data/synthetic/file_00000.nc', 10, 20]
+    odd['var1/0.0'] = ['/data/synthetic/file_00000.nc', 10, 20]
+    odd['mask/0'] = ['/data/synthetic/mask.nc']
+    kfile = write_refs(tmp_path / 'odd.json', {'version': 1, 'refs': odd})
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    assert conv.process(verify=True)['ok']
+    assert set(conv.vars) == {'var0', 'var1'}
+    assert '/data/synthetic/mask.nc' not in conv.files
+    loaded = Converter(None, None, store=conv.store).load()
+    assert normalise(loaded['refs']) == normalise(odd)
+
+@pytest.mark.parametrize('verify', [True, 20])
+def test_verify_held_refs(kfile, tmp_path, monkeypatch, verify):
+    # process checks the refs it parsed rather than reading the file again
+    import verify as verify_module
+    monkeypatch.setattr(verify_module, 'json', None)
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    assert conv.process(verify=verify, fmt='kpk', shard=4)['ok']
+
+def test_kpk_columns_mapped(tmp_path):
+    # Id columns are used as written, not copied, and offsets past 2**31 add up
+    sizes = [2**29 + 8 * (k % 3) for k in range(16)]
+    offsets = np.concatenate(([100], 100 + np.cumsum(sizes[:-1]))).tolist()
+    refs = {'.zgroup': json.dumps({'zarr_format': 2}),
+            'big/.zarray': json.dumps({'shape': [16], 'chunks': [1]})}
+    refs.update({f'big/{k}': ['/data/big.nc', o, s] for k, (o, s) in enumerate(zip(offsets, sizes))})
+    kfile = write_refs(tmp_path / 'big.json', {'version': 1, 'refs': refs})
+    store = store_of(kfile, tmp_path, fmt='kpk')
+
+    conv = Converter(None, None, store=store)
+    conv.read_meta()
+    var = conv.vars['big']
+    var.load()
+    for column in (var.uniqueids, var.gapids, var.keyids, var.fileids, var.filerefs):
+        assert column.dtype == np.int32 and not column.flags.owndata
+    assert [var.lookup(str(k)) for k in range(16)] == [refs[f'big/{k}'] for k in range(16)]
+    assert np.array_equal(var.refs_at(np.arange(16))['offset'], offsets)
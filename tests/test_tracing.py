@@ -0,0 +1,60 @@
+# Stage spans and their trace output
+
+import json
+
+import pytest
+
+import tracing
+
+from convert import Converter
+
+@pytest.fixture
+def records():
+    records = []
+    tracing.enable(callback=records.append)
+    yield records
+    tracing.disable()
+
+def test_spans(records):
+    @tracing.traced('outer', lambda a, k, r: {'items': len(r)})
+    def outer(n):
+        with tracing.span('inner', files=1) as s:
+            s.count(files=2)
+            tracing.current().count(chunks=n)
+        return list(range(n))
+
+    outer(5)
+    inner, top = records
+    assert (inner['name'], inner['parent'], inner['depth']) == ('inner', 'outer', 1)
+    assert inner['counts'] == {'files': 3, 'chunks': 5}
+    assert (top['name'], top['parent'], top['counts']) == ('outer', None, {'items': 5})
+    assert top['wall_s'] >= inner['wall_s'] >= 0 and top['error'] is None
+    assert {'cpu_s', 'peak_rss_mb', 'rss_growth_mb', 'pid', 'thread', 'start'} <= set(top)
+
+def test_errors(records):
+    with pytest.raises(KeyError):
+        with tracing.span('failing'):
+            raise KeyError('x')
+    assert records[0]['error'] == 'KeyError'
+
+def test_disabled():
+    # One shared no-op span, traced functions called directly
+    assert not tracing.enabled()
+    assert tracing.span('a') is tracing.NULL and tracing.current() is tracing.NULL
+    with tracing.span('a') as s:
+        s.count(items=1)
+
+def test_trace_file(kfile, tmp_path):
+    # A conversion and load traced to JSON lines
+    path = tmp_path / 'trace.jsonl'
+    tracing.enable(path=str(path))
+    try:
+        conv = Converter(kfile, str(tmp_path / 'kstore'))
+        conv.process(fmt='kpk')
+        Converter(None, None, store=conv.store).load()
+    finally:
+        tracing.disable()
+    f = open(path, 'r')
+    names = [json.loads(line)['name'] for line in f]
+    f.close()
+    assert {'get_kfile', 'deconstruct', 'pack_gen', 'write_bin', 'read_meta', 'unpack_gen'} <= set(names)
@@ -0,0 +1,103 @@
+# Lazy store mapper lookups and chunk reads
+
+import numpy as np
+import pytest
+
+import synthetic
+
+from cache import ChunkCache
+from convert import Converter
+from helpers import normalise, read_refs, write_data
+from unpack import KStoreRefs, get_mapper
+
+@pytest.fixture(params=[{'fmt': 'json'}, {'fmt': 'kpk', 'shard': 3}])
+def store(kfile, tmp_path, request):
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(**request.param)
+    return conv.store
+
+@pytest.fixture
+def local(tmp_path):
+    # Synthetic refs into files that exist, for reads through the mapper
+    # Chunks keep the standard size so zarr can decode them
+    data = tmp_path / 'data'
+    data.mkdir()
+    kfile = str(tmp_path / 'local.json')
+    synthetic.write_kerchunk(kfile, nchunks=800, nvars=2, nfiles=4, irregular=0.0,
+                             gaps=0.05, prefix=str(data))
+    refs = read_refs(kfile)
+    write_data(refs)
+    conv = Converter(kfile, str(tmp_path / 'kstore'))
+    conv.process(fmt='kpk')
+    return conv.store, refs
+
+def read_ref(ref):
+    f = open(ref[0], 'rb')
+    f.seek(ref[1])
+    data = f.read(ref[2])
+    f.close()
+    return data
+
+def test_lookups(store, refs):
+    lazy = KStoreRefs(store)
+    assert len(lazy) == len(refs['refs'])
+    assert normalise({k: lazy[k] for k in refs['refs'] if not isinstance(lazy[k], bytes)}) == \
+        normalise({k: v for k, v in refs['refs'].items() if not isinstance(lazy[k], bytes)})
+    assert 'var0/9.9.9' in lazy
+    assert 'var0/10.0.0' not in lazy
+    with pytest.raises(KeyError):
+        lazy['var0/10.0.0']
+    with pytest.raises(KeyError):
+        lazy['var0/a.b.c']
+    assert sorted(lazy) == sorted(refs['refs'])
+
+def test_lookup_many(store, refs):
+    lazy = KStoreRefs(store)
+    keys = [k for k in refs['refs'] if k.startswith('var1/')][::7] + ['var1/99.0.0', 'time/0']
+    found = lazy.lookup_many(keys)
+    assert found == {k: refs['refs'][k] for k in keys if k.startswith('var1/') and k in refs['refs']
+                     and not k.split('/')[1].startswith('.')}
+
+def test_open_is_lazy(store, monkeypatch):
+    # Opening takes the remote protocol from the file list, not the chunk refs
+    monkeypatch.setattr(KStoreRefs, '__iter__', None)
+    fs = get_mapper('reference://', fo=store).fs
+    assert 'file' in fs.fss
+
+def test_iter_blocks(store, refs, monkeypatch):
+    import unpack
+    monkeypatch.setattr(unpack, 'KEY_BLOCK', 64)
+    assert list(KStoreRefs(store)) == list(KStoreRefs(store).meta_keys()) + \
+        [k for var in KStoreRefs(store).vars.values() for k in var.chunk_keys(prefix=f'{var.var}/').tolist()]
+
+def test_listing(store):
+    fs = get_mapper('reference://', fo=store).fs
+    assert {'var0', 'var1', 'time'} <= set(fs.ls('', detail=False))
+    assert len([k for k in fs.ls('var0', detail=False) if not k.split('/')[1].startswith('.')]) == 1000
+
+def test_cat(local):
+    store, refs = local
+    keys = [k for k, v in refs['refs'].items() if isinstance(v, list) and len(v) == 3]
+    for kwargs in [{}, {'max_gap': -1}, {'chunk_cache': ChunkCache(maxbytes=2**22)}]:
+        fs = get_mapper('reference://', fo=store, **kwargs).fs
+        for _ in range(2):
+            out = fs.cat(keys[::3])
+            assert {k: bytes(v) for k, v in out.items()} == {k: read_ref(refs['refs'][k]) for k in keys[::3]}
+        assert bytes(fs.cat(keys[5])) == read_ref(refs['refs'][keys[5]])
+
+def test_xarray(local):
+    xr = pytest.importorskip('xarray')
+    store, refs = local
+    ds = xr.open_zarr(get_mapper('reference://', fo=store), consolidated=False)
+    assert ds['var0'].shape[0] == len(ds['time'])
+    assert ds['var0'].isel(time=1).values.shape == ds['var0'].shape[1:]
+
+def test_refs_at(store):
+    # Per-position lookups agree with the fully decoded table
+    lazy = KStoreRefs(store)
+    for var in lazy.vars.values():
+        for part in var.parts():
+            table = part.ref_table()
+            assert np.array_equal(part.refs_at(np.arange(part.chunks)), table)
+            assert part.lookup(part.chunk_keys(gidx=part.key_index()[-1:])[0]) == \
+                [part.fileset[table[-1]['file']], int(table[-1]['offset']), int(table[-1]['size'])]
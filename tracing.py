@@ -0,0 +1,146 @@
+# Tracing.py
+
+# Named spans for timing conversion and read stages
+#  - A span records wall time, process CPU time, peak memory and item counts
+#  - Finished spans are appended as JSON lines to a trace file and/or passed
+#    to a callback, nested spans name their parent
+#  - While disabled, span returns one shared no-op object and traced
+#    functions are called directly
+#  - KSTORE_TRACE=<path> traces a run without code changes, '-' for stderr
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+STATE = {'enabled': False, 'path': None, 'callback': None}
+LOCK = threading.Lock()
+LOCAL = threading.local()
+
+def peak_rss():
+    # Peak resident memory of this process in MB
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 1024**2
+    return maxrss / 1024
+
+def enable(path=None, callback=None):
+    """
+    Start recording spans to path (JSON lines, '-' for stderr) and/or
+    callback(record).
+    """
+    STATE.update(enabled=True, path=path, callback=callback)
+
+def disable():
+    STATE.update(enabled=False, path=None, callback=None)
+
+def enabled():
+    return STATE['enabled']
+
+def emit(record):
+    if STATE['callback'] is not None:
+        STATE['callback'](record)
+    path = STATE['path']
+    if path is None:
+        return
+    line = json.dumps(record) + '\n'
+    with LOCK:
+        if path == '-':
+            sys.stderr.write(line)
+            return
+        # Appended whole lines, so worker processes can share one file
+        f = open(path, 'a')
+        f.write(line)
+        f.close()
+
+class Span:
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = dict(counts)
+
+    def count(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        stack = getattr(LOCAL, 'stack', None)
+        if stack is None:
+            stack = LOCAL.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.rss = peak_rss()
+        self.cpu = time.process_time()
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        LOCAL.stack.pop()
+        rss = peak_rss()
+        emit({
+            'name': self.name,
+            'parent': self.parent,
+            'depth': self.depth,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'start': round(self.start, 6),
+            'wall_s': round(wall, 6),
+            'cpu_s': round(cpu, 6),
+            'peak_rss_mb': round(rss, 1),
+            'rss_growth_mb': round(rss - self.rss, 1),
+            'counts': self.counts,
+            'error': exc[0].__name__ if exc[0] else None,
+        })
+        return False
+
+class NullSpan:
+    def count(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL = NullSpan()
+
+def span(name, **counts):
+    # Context manager timing a block, a no-op while tracing is disabled
+    if not STATE['enabled']:
+        return NULL
+    return Span(name, counts)
+
+def current():
+    # Innermost open span of this thread, for adding counts from inside it
+    stack = getattr(LOCAL, 'stack', None)
+    return stack[-1] if stack and STATE['enabled'] else NULL
+
+def traced(name, counts=None):
+    """
+    Decorator wrapping each call in span(name).
+
+    counts(args, kwargs, result) may return a dict of item counts for the
+    finished call.
+    """
+    def wrap(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            if not STATE['enabled']:
+                return func(*args, **kwargs)
+            with Span(name, {}) as s:
+                result = func(*args, **kwargs)
+                if counts is not None:
+                    s.count(**counts(args, kwargs, result))
+                return result
+        return inner
+    return wrap
+
+if os.environ.get('KSTORE_TRACE'):
+    enable(path=os.environ['KSTORE_TRACE'])
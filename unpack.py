@@ -0,0 +1,326 @@
+# Unpack.py
+
+# Open a kerchunk_store (.kst) without rebuilding the full kerchunk dict
+#  - KStoreRefs presents the store as a flat reference mapping
+#  - Chunk refs are worked out on demand from the packed Variable arrays
+#  - Inline data is read from the store's sidecar only when asked for
+#  - Multi-chunk reads merge nearby byte ranges in each file into one request
+#  - http(s) ranges can be fetched concurrently by a fetch.Fetcher
+#  - Chunk bytes can be kept in a cache.ChunkCache between reads
+#  - Sequential reads along the leading dimension can be prefetched
+#  - get_mapper mirrors fsspec.get_mapper for stores and kerchunk files
+
+import base64
+import json
+import os
+import time
+
+import fsspec
+import numpy as np
+from fsspec.implementations.reference import ReferenceFileSystem, ReferenceNotReachable
+from fsspec.core import split_protocol
+from collections.abc import Mapping
+from itertools import chain
+
+from cache import CHUNKS
+from convert import Converter
+from fetch import FETCHER
+from prefetch import Prefetcher
+from tracing import current, traced
+
+# Chunk keys formatted at a time when iterating over a store
+KEY_BLOCK = 100000
+
+def is_kstore(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, 'meta.json'))
+
+def coalesce(starts, ends, max_gap, max_block):
+    """
+    Merge sorted byte ranges of one file.
+
+    Ranges no more than max_gap bytes apart are joined while the merged
+    block stays within max_block. Returns (starts, ends, block) where
+    block gives the merged range each input range falls in.
+    """
+    mstarts, mends, block = [starts[0]], [ends[0]], [0]
+    for s, e in zip(starts[1:], ends[1:]):
+        if s - mends[-1] <= max_gap and max(e, mends[-1]) - mstarts[-1] <= max_block:
+            mends[-1] = max(e, mends[-1])
+        else:
+            mstarts.append(s)
+            mends.append(e)
+        block.append(len(mstarts) - 1)
+    return mstarts, mends, block
+
+class KStoreRefs(Mapping):
+    """
+    Read-only mapping of reference keys to [file, offset, size] for a .kst store.
+
+    Metadata refs are held as written in meta.json, inline data and chunk
+    refs are read from the sidecar and per-variable packs when requested.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.converter = Converter(None, None, store=store)
+        self.converter.read_meta()
+        self.refs = self.converter.metadata['refs']
+        self.inline = self.converter.inline
+        self.vars = self.converter.vars
+
+    def split(self, key):
+        var, _, chunk = key.partition('/')
+        if var in self.vars and chunk and chunk[0] != '.' and '/' not in chunk:
+            return self.vars[var], chunk
+        return None, None
+
+    def __getitem__(self, key):
+        if key in self.refs:
+            ref = self.refs[key]
+            if isinstance(ref, dict):
+                return json.dumps(ref)
+            return ref
+        if key in self.inline:
+            # Raw bytes, unless they would be mistaken for a base64 ref
+            data = self.inline.data(key)
+            if data.startswith(b'base64:'):
+                return 'base64:' + base64.b64encode(data).decode()
+            return data
+        var, chunk = self.split(key)
+        if var is None:
+            raise KeyError(key)
+        return var.lookup(chunk)
+
+    def lookup_many(self, keys):
+        # [file, offset, size] for the chunk keys among keys, grouped by variable
+        groups = {}
+        for key in keys:
+            var, chunk = self.split(key)
+            if var is not None and key not in self.refs:
+                groups.setdefault(var.var, []).append(chunk)
+        refs = {}
+        for name, chunks in groups.items():
+            found = self.vars[name].lookup_many(chunks)
+            refs.update({f'{name}/{chunk}': ref for chunk, ref in found.items()})
+        return refs
+
+    def meta_keys(self):
+        return chain(self.refs, self.inline)
+
+    def __contains__(self, key):
+        if key in self.refs or key in self.inline:
+            return True
+        var, chunk = self.split(key)
+        return var is not None and var.find(chunk) is not None
+
+    def __iter__(self):
+        # Chunk keys are formatted KEY_BLOCK at a time
+        yield from self.meta_keys()
+        for var in self.vars.values():
+            for start in range(0, var.chunks, KEY_BLOCK):
+                pos = np.arange(start, min(start + KEY_BLOCK, var.chunks))
+                yield from var.chunk_keys(prefix=f'{var.var}/', gidx=var.key_index_at(pos)).tolist()
+
+    def __len__(self):
+        total = len(self.refs) + len(self.inline)
+        for var in self.vars.values():
+            total += var.chunks
+        return total
+
+    def protocol(self):
+        # Protocol of the data files, from the first file name rather than the refs
+        for var in self.vars.values():
+            if len(var.fileset):
+                return split_protocol(var.fileset[0])[0] or 'file'
+        return None
+
+    def listdir(self):
+        # Top level directories without touching the chunk refs
+        dirs = set(self.vars)
+        for key in self.meta_keys():
+            if '/' in key:
+                dirs.add(key.split('/')[0])
+        return dirs
+
+    def entry(self, key, detail):
+        if not detail:
+            return key
+        if key in self.inline:
+            return {'name': key, 'type': 'file', 'size': self.inline.index[key][1]}
+        ref = self[key]
+        if isinstance(ref, (str, bytes)):
+            size = len(ref)
+        elif len(ref) == 1:
+            size = None
+        else:
+            size = ref[2]
+        return {'name': key, 'type': 'file', 'size': size}
+
+    def ls(self, path, detail=True):
+        path = path.rstrip('/')
+        if path == '':
+            out = [self.entry(key, detail) for key in self.meta_keys() if '/' not in key]
+            for name in sorted(self.listdir()):
+                out.append({'name': name, 'type': 'directory', 'size': 0} if detail else name)
+            return out
+        if path not in self.listdir():
+            raise FileNotFoundError(path)
+        out = [self.entry(key, detail) for key in self.meta_keys() if key.startswith(f'{path}/')]
+        if path in self.vars:
+            chunks = self.vars[path].chunk_keys(prefix=f'{path}/').tolist()
+            out += [self.entry(key, detail) for key in chunks]
+        return out
+
+class KStoreFileSystem(ReferenceFileSystem):
+    """
+    ReferenceFileSystem over a KStoreRefs mapping.
+
+    Directory listings come from the store layout rather than a dircache
+    built from every reference. Chunk ranges are read through the fsspec
+    filesystem for their protocol, with its remote_options. fetcher sends
+    http(s) ranges through a fetch.Fetcher instead, True for the shared
+    FETCHER or a Fetcher of your own. Its aiohttp session does not see
+    remote_options, so headers or auth have to be given to the Fetcher.
+    chunk_cache keeps chunk bytes between reads, True for the shared
+    CHUNKS cache or a ChunkCache of your own. prefetch reads ahead along
+    the leading dimension, True or a dict of Prefetcher options.
+    Without fs or remote_protocol the protocol is taken from the store's
+    first file, ReferenceFileSystem would otherwise iterate the refs.
+    """
+    def __init__(self, *args, fetcher=None, chunk_cache=None, prefetch=None, **kwargs):
+        refs = kwargs.get('fo', args[0] if args else None)
+        if isinstance(refs, KStoreRefs) and kwargs.get('fs') is None and kwargs.get('remote_protocol') is None:
+            kwargs['remote_protocol'] = refs.protocol()
+        super().__init__(*args, **kwargs)
+        self.fetcher = FETCHER if fetcher is True else fetcher
+        self.chunk_cache = CHUNKS if chunk_cache is True else chunk_cache
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = Prefetcher(self, **(prefetch if isinstance(prefetch, dict) else {}))
+
+    def ls(self, path, detail=True, **kwargs):
+        path = self._strip_protocol(path)
+        if path in self.references:
+            return [self.references.entry(path, detail)]
+        return self.references.ls(path, detail)
+
+    def isdir(self, path):
+        path = self._strip_protocol(path).rstrip('/')
+        return path == '' or path in self.references.listdir()
+
+    def cat(self, path, recursive=False, on_error='raise', **kwargs):
+        """
+        Fetch many refs with as few range requests as possible.
+
+        Chunk ranges are grouped by file and merged when the gap between
+        them is at most max_gap bytes, up to max_block bytes per request
+        (both set when the filesystem is made). Each chunk comes back as a
+        memoryview onto the merged buffer, not a copy. Chunks held in
+        chunk_cache are not fetched at all.
+        """
+        single = isinstance(path, str)
+        if recursive or not (single or isinstance(path, list)) or (single and '*' in path):
+            return super().cat(path, recursive=recursive, on_error=on_error, **kwargs)
+        paths = [path] if single else path
+        began = time.perf_counter()
+        out, ranges = {}, {}
+        keys = [self._strip_protocol(p) for p in paths]
+        chunks = self.references.lookup_many(keys)
+        for p, key in zip(paths, keys):
+            ref = chunks.get(key)
+            if ref is not None:
+                url, start, size = ref
+                data = self.prefetcher.take(key) if self.prefetcher else None
+                if data is None and self.chunk_cache:
+                    data = self.chunk_cache.get(url, start, size)
+                if data is not None:
+                    out[p] = data
+                else:
+                    ranges.setdefault(url, []).append((start, start + size, p))
+                continue
+            try:
+                url, start, end = self._cat_common(p)
+            except FileNotFoundError as err:
+                if on_error == 'raise':
+                    raise
+                if on_error != 'omit':
+                    out[p] = err
+                continue
+            if isinstance(url, bytes):
+                out[p] = url
+            elif start is None:
+                # Whole file refs are read on their own
+                out[p] = self.cat_file(p)
+            else:
+                ranges.setdefault(url, []).append((start, end, p))
+
+        fetched = self.fetch_ranges(ranges) if ranges else {}
+        for p, data in fetched.items():
+            if not isinstance(data, Exception):
+                out[p] = data
+                continue
+            err = ReferenceNotReachable(p, self.references[p])
+            err.__cause__ = data
+            if on_error == 'raise':
+                raise err
+            if on_error != 'omit':
+                out[p] = err
+        if self.prefetcher:
+            self.prefetcher.observe(list(chunks), time.perf_counter() - began)
+        if single and len(out) == 1:
+            return out[path]
+        return out
+
+    @traced('fetch', lambda a, k, r: {'chunks': len(r), 'bytes': sum(len(d) for d in r.values() if not isinstance(d, Exception))})
+    def fetch_ranges(self, ranges):
+        # {path: bytes or exception} for {url: [(start, end, path)]}, merged and batched
+        out = {}
+        urls, starts, ends, parts = [], [], [], []
+        for url, group in ranges.items():
+            group.sort()
+            mstarts, mends, block = coalesce([g[0] for g in group], [g[1] for g in group],
+                                             self.max_gap, self.max_block)
+            for (start, end, p), b in zip(group, block):
+                parts.append((p, url, start, end, len(urls) + b, mstarts[b]))
+            urls += [url] * len(mstarts)
+            starts += mstarts
+            ends += mends
+
+        # One batch per target protocol
+        current().count(requests=len(urls))
+        buffers = [None] * len(urls)
+        protocols = {}
+        for i, url in enumerate(urls):
+            protocols.setdefault(split_protocol(url)[0], []).append(i)
+        for protocol, index in protocols.items():
+            batch = ([urls[i] for i in index], [starts[i] for i in index], [ends[i] for i in index])
+            if self.fetcher and protocol in ('http', 'https'):
+                data = self.fetcher.fetch(*batch)
+            else:
+                data = self.fss[protocol].cat_ranges(*batch, on_error='return')
+            for i, d in zip(index, data):
+                buffers[i] = d if isinstance(d, Exception) else memoryview(d)
+
+        for p, url, start, end, b, offset in parts:
+            data = buffers[b]
+            if isinstance(data, Exception):
+                out[p] = data
+                continue
+            out[p] = data[start-offset:end-offset]
+            if self.chunk_cache:
+                self.chunk_cache.put(url, start, end - start, out[p])
+        return out
+
+def get_mapper(url, fo=None, **kwargs):
+    """
+    Drop-in for fsspec.get_mapper("reference://", fo=...).
+
+    Stores (.kst directories) are opened lazily, anything else is passed
+    through to fsspec. max_gap and max_block set how far multi-chunk reads
+    from a store are merged, fetcher whether http(s) ranges go through
+    a concurrent fetch.Fetcher, chunk_cache where chunk bytes are kept
+    between reads and prefetch whether timestep loops are read ahead.
+    """
+    if is_kstore(fo):
+        fs = KStoreFileSystem(fo=KStoreRefs(fo), **kwargs)
+        return fs.get_mapper('')
+    return fsspec.get_mapper(url, fo=fo, **kwargs)
@@ -0,0 +1,199 @@
+# Verify.py
+
+# Check a kerchunk_store (.kst) against the kerchunk refs it was made from
+#  - Full mode compares file, offset and size as int64 arrays per variable
+#  - Sample mode checks N random chunks per variable through the packs
+#  - Reports counts and the first mismatching keys with their refs
+
+import json
+import numpy as np
+
+from convert import Converter, KEYWORDS, split_keys
+
+def ref_list(names, row):
+    return [names[int(row['file'])], int(row['offset']), int(row['size'])]
+
+def compare_meta(original, converter):
+    # Top level entries and metadata refs must match exactly
+    stored = converter.metadata['refs']
+    mismatched = []
+    checked = 0
+    for key, ref in original.items():
+        if key in ('refs', 'vars', 'files', 'format', 'encoding', 'gfactor'):
+            continue
+        checked += 1
+        if converter.metadata.get(key) != ref:
+            mismatched.append(key)
+    for key, ref in original['refs'].items():
+        checked += 1
+        if key not in stored or stored[key] != ref:
+            mismatched.append(key)
+    for key in stored:
+        if key not in original['refs']:
+            mismatched.append(key)
+    return {'checked': checked, 'mismatches': len(mismatched), 'first': mismatched[:10]}
+
+def split_refs(refs, names):
+    """
+    Metadata refs and per-variable chunk columns of the original refs.
+
+    Refs are sorted as Converter.add_ref does. Chunk refs for variables
+    not in names stay with the metadata refs, where they are reported as
+    mismatches.
+    """
+    keys = list(refs)
+    columns, claimed = {}, set()
+    for var in names:
+        if var in KEYWORDS:
+            continue
+        prefix = f'{var}/'
+        n = len(prefix)
+        vkeys = [k for k in keys if k.startswith(prefix) and k[n:n+1] != '.' and '/' not in k[n:]]
+        vkeys = [k for k in vkeys if isinstance(refs[k], list) and len(refs[k]) == 3]
+        if not vkeys:
+            continue
+        coords, valid = split_keys(vkeys, vkeys[0][n:].count('.') + 1, skip=n)
+        if not valid.all():
+            vkeys = [k for k, v in zip(vkeys, valid) if v]
+
+        claimed.update(vkeys)
+        values = [refs[k] for k in vkeys]
+        columns[var] = {
+            'coords': coords,
+            'files': [v[0] for v in values],
+            'offset': np.fromiter((v[1] for v in values), dtype=np.int64, count=len(values)),
+            'size': np.fromiter((v[2] for v in values), dtype=np.int64, count=len(values)),
+        }
+    meta = {k: refs[k] for k in keys if k not in claimed}
+    return meta, columns
+
+def compare_variable(var, columns, context=10):
+    """
+    Compare a loaded store Variable with the original refs for it.
+
+    Chunks are matched on grid index so pack order does not matter, files
+    are compared by name.
+    """
+    coords = columns['coords']
+    n = len(coords)
+    result = {'chunks': n, 'stored': var.chunks, 'missing': 0, 'extra': 0, 'mismatches': 0, 'first': []}
+    if coords.shape[1] != len(var.grid):
+        result['missing'], result['extra'] = n, var.chunks
+        return result
+    inside = np.all(coords < np.array(var.grid), axis=1)
+    ogidx = np.full(n, -1, dtype=np.int64)
+    ogidx[inside] = np.ravel_multi_index(tuple(coords[inside].T), var.grid)
+
+    # Files as ids shared between the original names and the store file list
+    names = {}
+    ofile = np.array([names.setdefault(f, len(names)) for f in columns['files']], dtype=np.int64)
+    sids = np.array([names.setdefault(f, len(names)) for f in var.fileset], dtype=np.int64)
+    ooffset, osize = columns['offset'], columns['size']
+
+    sgidx = var.key_index()
+    table = var.ref_table()
+    common, oi, si = np.intersect1d(ogidx, sgidx, assume_unique=True, return_indices=True)
+    result['missing'] = int(n - len(common))
+    result['extra'] = int(var.chunks - len(common))
+
+    bad = (
+        (ofile[oi] != sids[table['file'][si]]) |
+        (ooffset[oi] != table['offset'][si]) |
+        (osize[oi] != table['size'][si])
+    )
+    result['mismatches'] = int(bad.sum())
+    if not bad.any():
+        return result
+
+    # First mismatches in the order of the original refs
+    order = np.sort(oi[bad])[:context]
+    position = dict(zip(oi.tolist(), si.tolist()))
+    keys = var.chunk_keys(prefix=f'{var.var}/', gidx=ogidx[order]).tolist()
+    original = lambda o: [columns['files'][o], int(ooffset[o]), int(osize[o])]
+    for key, o in zip(keys, order.tolist()):
+        entry = {
+            'key': key,
+            'original': original(o),
+            'store': ref_list(var.fileset, table[position[o]]),
+        }
+        if o > 0:
+            entry['previous'] = original(o-1)
+        result['first'].append(entry)
+    return result
+
+def verify_full(converter, original, context=10):
+    meta, columns = split_refs(original['refs'], converter.vars)
+    top = {k: v for k, v in original.items() if k != 'refs'}
+    report = {'mode': 'full', 'metadata': compare_meta({**top, 'refs': meta}, converter), 'vars': {}}
+    for name, cols in columns.items():
+        var = converter.vars[name]
+        var.load()
+        report['vars'][name] = compare_variable(var, cols, context=context)
+    for name in set(converter.vars) - set(columns):
+        var = converter.vars[name]
+        report['vars'][name] = {'chunks': 0, 'stored': var.chunks, 'missing': 0, 'extra': var.chunks,
+                                'mismatches': 0, 'first': []}
+    return report
+
+def verify_sample(converter, original, sample, context=10, seed=None):
+    # Random chunks per variable looked up from the packs and the original dict
+    rng = np.random.default_rng(seed)
+    refs = original['refs']
+    report = {'mode': 'sample', 'vars': {}}
+
+    # Metadata refs are few, they are always checked in full
+    meta = {k: v for k, v in original.items() if k != 'refs'}
+    meta['refs'] = {k: v for k, v in refs.items() if k in converter.metadata['refs']}
+    report['metadata'] = compare_meta(meta, converter)
+    total = len(converter.metadata['refs']) + sum(var.chunks for var in converter.vars.values())
+    report['count'] = {'original': len(refs), 'stored': total}
+
+    for name, var in converter.vars.items():
+        var.load()
+        count = min(sample, var.chunks)
+        index = np.sort(rng.choice(var.chunks, count, replace=False))
+        # Only the sampled positions are decoded
+        keys = var.chunk_keys(prefix=f'{name}/', gidx=var.key_index_at(index)).tolist()
+        table = var.refs_at(index)
+        result = {'chunks': var.chunks, 'checked': count, 'missing': 0, 'mismatches': 0, 'first': []}
+        for key, row in zip(keys, table):
+            stored = ref_list(var.fileset, row)
+            ref = refs.get(key)
+            if ref is None:
+                result['missing'] += 1
+            elif ref[0] == stored[0] and int(ref[1]) == stored[1] and int(ref[2]) == stored[2]:
+                continue
+            else:
+                result['mismatches'] += 1
+            if len(result['first']) < context:
+                result['first'].append({'key': key, 'original': ref, 'store': stored})
+        report['vars'][name] = result
+    return report
+
+def verify_store(store, original, sample=None, context=10, seed=None):
+    """
+    Verify a store against its original kerchunk refs (file path or dict).
+
+    Pass the dict when it is already in memory, a path is parsed again.
+
+    sample checks that many random chunks per variable instead of all of
+    them. Returns a report dict, report['ok'] is True when nothing differs.
+    """
+    if isinstance(original, str):
+        f = open(original, 'r')
+        original = json.load(f)
+        f.close()
+    converter = Converter(None, None, store=store)
+    converter.read_meta()
+    converter.metadata['refs'].update(converter.inline.refs())
+    if sample:
+        report = verify_sample(converter, original, sample, context=context, seed=seed)
+        ok = report['count']['original'] == report['count']['stored']
+    else:
+        report = verify_full(converter, original, context=context)
+        ok = True
+    ok = ok and report['metadata']['mismatches'] == 0
+    for result in report['vars'].values():
+        ok = ok and not (result['missing'] or result.get('extra') or result['mismatches'])
+    report['ok'] = ok
+    return report